@@ -15,19 +15,132 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # *------------------------------------------------------------------------------*
 
-from flask import Flask, request, render_template
-import psycopg2
+from flask import (Flask, request, render_template, g, stream_with_context,
+                   abort, redirect, send_file, url_for, has_request_context)
+from markupsafe import Markup
+from werkzeug.http import is_resource_modified
 from psycopg2.extras import RealDictCursor
 import json
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import arrow
 import groupy
-import schedule  # mrhwick's fork on github
 import threading
 import time
 import sys
-
-group_jobs = []
+import os
+import re
+import itertools
+import argparse
+import multiprocessing
+import signal
+import traceback
+from collections import OrderedDict
+from ingest import (attachment_row, bulk_insert_messages, bulk_upsert_groups,
+                    bulk_upsert_members)
+from db import ConnectionPool, Listener
+from scheduler import SyncScheduler
+from leases import Leases, LeaseLost
+from fetcher import Fetcher
+from directory import Directory
+from pagecache import PageCache
+from media import MediaMirror
+from metrics import Metrics
+import transfer
+from schema import migrate, SEARCH_CONFIG, SEARCH_VECTOR
+
+# Number of groups synced concurrently
+SYNC_WORKERS = 4
+
+# Seconds a syncing process's claim on a group lasts unless renewed, and
+# seconds between renewals. The groups of a process that died are taken
+# over by the others within SYNC_LEASE_TTL seconds.
+SYNC_LEASE_TTL = 60
+SYNC_HEARTBEAT = 15
+
+# Notification channels announcing changes to cached pages and members, and
+# newly archived groups to the syncing processes. User ids are notified
+# NOTIFY_USERS at a time to stay under the payload limit.
+CHANGES_CHANNEL = 'archive_changes'
+ARCHIVED_CHANNEL = 'groups_archived'
+NOTIFY_USERS = 500
+
+# Seconds between syncs of an active group. Groups without new messages are
+# polled less and less often, up to SYNC_MAX_INTERVAL seconds apart.
+SYNC_INTERVAL = 60
+SYNC_MAX_INTERVAL = 900
+
+# GroupMe API requests per second (and burst size) shared by all syncs,
+# HTTP connections kept open to the API, and message pages fetched ahead of
+# the one being written
+FETCH_RATE = 5
+FETCH_BURST = 10
+FETCH_CONNECTIONS = 8
+FETCH_PREFETCH = 2
+
+# Number of fetched messages written and checkpointed per transaction
+SYNC_BATCH_SIZE = 1000
+
+# Likes keep changing after a message is archived. Every
+# LIKES_REFRESH_INTERVAL seconds a sync re-fetches the group's messages from
+# the last LIKES_WINDOW_HOURS hours, at most LIKES_WINDOW_MESSAGES of them,
+# and stores the likes that changed.
+LIKES_REFRESH_INTERVAL = 600
+LIKES_WINDOW_HOURS = 48
+LIKES_WINDOW_MESSAGES = 1000
+
+# Database connections shared by web requests and sync jobs; callers wait
+# for a free connection when all are in use
+DB_POOL_SIZE = 10
+
+# Seconds a pooled connection may sit idle before it is checked with a
+# trivial query on its next checkout
+DB_HEALTH_CHECK_INTERVAL = 30
+
+# Seconds the listing of our groups and DM partners is cached. Unknown ids
+# force a refresh at most once per DIRECTORY_MIN_REFRESH seconds, which is
+# also how soon a failed refresh is retried.
+DIRECTORY_TTL = 300
+DIRECTORY_MIN_REFRESH = 30
+
+# Seconds our own GroupMe profile is cached for DM syncs
+DM_PROFILE_TTL = 3600
+
+# Number of (group, member) nickname/avatar lookups kept in memory
+MEMBER_CACHE_SIZE = 10000
+
+# Most messages a timeline page shows, whatever its num argument asks for
+MAX_PAGE_SIZE = 1000
+
+# Rows fetched per round trip by listings, which are streamed to the client
+# from a server-side cursor instead of being loaded at once
+STREAM_ITERSIZE = 1000
+
+# Bytes of rendered timeline pages kept in memory
+PAGE_CACHE_BYTES = 64 * 1024 * 1024
+
+# Images and avatars on MEDIA_HOSTS are downloaded by MEDIA_WORKERS threads
+# into MEDIA_ROOT, with thumbnails that fit MEDIA_THUMBNAIL_SIZE pixels, and
+# served from /media with a cache lifetime of MEDIA_MAX_AGE seconds
+MEDIA_HOSTS = ('i.groupme.com',)
+MEDIA_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media')
+MEDIA_WORKERS = 4
+MEDIA_THUMBNAIL_SIZE = 400
+MEDIA_MAX_AGE = 365 * 24 * 3600
+
+# Queries that take at least this many seconds are logged, with the page
+# that ran them. None turns the slow query log off.
+SLOW_QUERY_SECONDS = None
+
+# Messages per page of the JSON API, by default and at most
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+
+# Messages as the templates see them, with their likes and attachments
+MESSAGE_COLUMNS = (
+    "messages.*, "
+    "ARRAY(SELECT user_id FROM message_likes WHERE message_id = messages.id) AS likes, "
+    "ARRAY(SELECT json_build_object('type', type, 'url', url, 'name', name) "
+    "FROM message_attachments WHERE message_id = messages.id ORDER BY position) AS attachments")
 
 
 def json_serial(obj):
@@ -38,6 +151,12 @@ def json_serial(obj):
         return serial
     raise TypeError("Type not serializable")
 
+
+def json_response(data, status=200):
+    return app.response_class(
+        json.dumps(data, default=json_serial, separators=(',', ':')),
+        status=status, mimetype='application/json')
+
 # http://codereview.stackexchange.com/a/37287
 
 
@@ -59,257 +178,1224 @@ def verbose_timedelta(delta):
 app = Flask(__name__, static_url_path='/static')
 #app.debug = True
 
-if len(sys.argv) == 4:
-    conn = psycopg2.connect(
-        database=sys.argv[1],
-        user=sys.argv[2],
-        password=sys.argv[3])
-    conn_args = {
-        'database': sys.argv[1],
-        'user': sys.argv[2],
-        'password': sys.argv[3]}
-elif len(sys.argv) == 3:
-    conn = psycopg2.connect(database=sys.argv[1], user=sys.argv[2])
-    conn_args = {'database': sys.argv[1], 'user': sys.argv[2]}
-elif len(sys.argv) == 2:
-    conn = psycopg2.connect(database=sys.argv[1])
-    conn_args = {'database': sys.argv[1]}
-
-cur = conn.cursor(cursor_factory=RealDictCursor)
-
-cur.execute("""
-  CREATE TABLE IF NOT EXISTS messages(
-    id text PRIMARY KEY,
-    name text,
-    message text,
-    attachments text[],
-    avatar_url text,
-    created_at timestamp with time zone,
-    user_id text,
-    group_id text,
-    likes text[]
-  )
-""")
-
-cur.execute("""
-  CREATE TABLE IF NOT EXISTS members(
-    user_id text,
-    nickname text,
-    avatar text,
-    group_id text,
-    UNIQUE (user_id, group_id)
-  )
-""")
-
-cur.execute("""
-  CREATE TABLE IF NOT EXISTS groups(
-    name text,
-    image_url text,
-    description text,
-    id text PRIMARY KEY,
-    type text
-  )
-""")
-
-
-def member_avatar(id):
-    cur.execute("SELECT avatar FROM members WHERE user_id = %s;", (id,))
-    return cur.fetchone()['avatar']
-
-
-def member_nickname(id, group_id):
+metrics = Metrics()
+metrics.counter('groupme_http_requests_total',
+                'Requests handled, by endpoint and status.')
+metrics.histogram('groupme_http_request_duration_seconds',
+                  'Time to handle a request, up to the start of the response.')
+metrics.histogram('groupme_http_request_queries',
+                  'SQL queries run per request.',
+                  buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500))
+metrics.counter('groupme_http_request_query_seconds_total',
+                'Time requests spent running SQL queries.')
+metrics.histogram('groupme_db_query_duration_seconds',
+                  'Duration of SQL queries from requests and background jobs.')
+metrics.counter('groupme_sync_runs_total', 'Syncs of a group, finished or failed.')
+metrics.counter('groupme_sync_failures_total', 'Syncs of a group that failed.')
+metrics.counter('groupme_sync_seconds_total', 'Time spent syncing a group.')
+metrics.counter('groupme_sync_messages_total', 'Newly archived messages of a group.')
+metrics.counter('groupme_sync_likes_changed_total',
+                'Likes of archived messages of a group added or removed by a sync.')
+metrics.counter('groupme_sync_pages_total', 'Message pages of a group fetched from the API.')
+metrics.counter('groupme_sync_api_requests_total',
+                'API requests made for message pages of a group, with retries.')
+metrics.counter('groupme_sync_api_seconds_total',
+                'Time spent waiting for API responses with messages of a group.')
+metrics.gauge('groupme_sync_messages_per_second',
+              'Archiving rate of the last sync of a group that found new messages.')
+metrics.gauge('groupme_sync_lag_seconds',
+              'Time since the archive of a group last caught up with the API.')
+
+
+def record_query(query, seconds):
+    """Called with every query run on a pooled connection."""
+
+    metrics.observe('groupme_db_query_duration_seconds', seconds)
+    if has_request_context():
+        g.queries = g.get('queries', 0) + 1
+        g.query_seconds = g.get('query_seconds', 0.0) + seconds
+    if SLOW_QUERY_SECONDS is not None and seconds >= SLOW_QUERY_SECONDS:
+        print("SLOW QUERY {0:.3f}s {1}: {2}".format(
+            seconds,
+            request.full_path if has_request_context() else "(background)",
+            ' '.join(str(query).split())), file=sys.stderr)
+
+
+# Set up by create_app(); nothing connects to the database before then.
+db_pool = None
+media_mirror = None
+changes_listener = None
+archived_listener = None
+group_leases = None
+
+
+def get_connection():
+    """Return the current request's pooled connection, checking one out on
+    first use."""
+
+    if getattr(g, 'db', None) is None:
+        g.db = db_pool.getconn()
+    return g.db
+
+
+def get_cursor():
+    return get_connection().cursor(cursor_factory=RealDictCursor)
+
+
+stream_cursor_ids = itertools.count()
+
+
+def stream_query(query, params=()):
+    """Run a query on a server-side cursor of the current request's
+    connection and return the cursor, which fetches the rows STREAM_ITERSIZE
+    at a time as it is iterated. Errors in the query are raised here, before
+    any response is streamed."""
+
+    cur = get_connection().cursor(
+        'stream_{0}'.format(next(stream_cursor_ids)),
+        cursor_factory=RealDictCursor)
+    cur.itersize = STREAM_ITERSIZE
+    cur.execute(query, params)
+    return cur
+
+
+def stream_template(template_name, **context):
+    """Render a template as a streamed response. Rows of a stream_query()
+    passed to it are fetched while the page is being sent."""
+
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(50)
+
+    # The response is sent after the request has been torn down, so it
+    # returns the request's connection itself once it is closed. That also
+    # happens when the body is never sent, e.g. for HEAD requests.
+    conn = getattr(g, 'db', None)
+    g.db = None
+
+    response = app.response_class(stream_with_context(stream))
+    if conn is not None:
+        response.call_on_close(lambda: db_pool.putconn(conn))
+    return response
+
+
+@app.before_request
+def listen_for_changes():
+    # Only requests use the cached pages and members, so a process hears
+    # about changes from its first request on.
+    changes_listener.start()
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.queries = 0
+    g.query_seconds = 0.0
+
+
+@app.after_request
+def record_request_metrics(response):
+    # Streamed responses are counted up to their first chunk.
+    endpoint = request.endpoint or 'none'
+    metrics.inc('groupme_http_requests_total', endpoint=endpoint,
+                status=response.status_code)
+    metrics.observe('groupme_http_request_duration_seconds',
+                    time.perf_counter() - g.request_started, endpoint=endpoint)
+    metrics.observe('groupme_http_request_queries', g.queries, endpoint=endpoint)
+    metrics.inc('groupme_http_request_query_seconds_total', g.query_seconds,
+                endpoint=endpoint)
+    return response
+
+
+@app.teardown_appcontext
+def release_connection(exception):
+    conn = getattr(g, 'db', None)
+    if conn is not None:
+        g.db = None
+        db_pool.putconn(conn)
+
+
+class MemberCache:
+    """LRU cache of member nicknames and avatars keyed by (group_id, user_id).
+    Members whose rows a sync changes are invalidated through notifications
+    from whichever process ran it, see apply_change().
+
+    Lookups read generation() before querying the members and pass it to
+    put_many(), which drops them if an invalidation ran in between, since
+    they may predate it."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def get_many(self, group_id, user_ids):
+        found = {}
+        with self.lock:
+            for user_id in user_ids:
+                key = (group_id, user_id)
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[user_id] = self.entries[key]
+        return found
+
+    def generation(self):
+        with self.lock:
+            return self.invalidations
+
+    def put_many(self, group_id, members, generation):
+        with self.lock:
+            if generation != self.invalidations:
+                return
+            for user_id, member in members.items():
+                self.entries[(group_id, user_id)] = member
+                self.entries.move_to_end((group_id, user_id))
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_ids):
+        # A member's avatar can be shown in other groups too, so drop every
+        # entry for the user.
+        user_ids = set(user_ids)
+        with self.lock:
+            self.invalidations += 1
+            for key in [key for key in self.entries if key[1] in user_ids]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.invalidations += 1
+            self.entries.clear()
+
+member_cache = MemberCache(MEMBER_CACHE_SIZE)
+page_cache = PageCache(PAGE_CACHE_BYTES)
+
+
+def notify_messages(cur, group_id, message_ids):
+    """Have every process drop its cached pages of the group around
+    ``message_ids`` once the current transaction commits."""
+
+    if message_ids:
+        cur.execute("SELECT pg_notify(%s, %s);", (
+            CHANGES_CHANNEL,
+            'messages {0} {1} {2}'.format(group_id, min(message_ids),
+                                          max(message_ids))))
+
+
+def notify_users(cur, user_ids):
+    """Have every process drop its cached names and avatars of ``user_ids``,
+    and the pages showing them, once the current transaction commits."""
+
+    user_ids = sorted(set(user_ids))
+    for start in range(0, len(user_ids), NOTIFY_USERS):
+        cur.execute("SELECT pg_notify(%s, %s);", (
+            CHANGES_CHANNEL,
+            ' '.join(['users'] + user_ids[start:start + NOTIFY_USERS])))
+
+
+def apply_change(payload):
+    kind, args = payload.split(' ', 1)
+    if kind == 'messages':
+        group_id, low, high = args.split()
+        page_cache.invalidate(group_id, int(low), int(high))
+    elif kind == 'users':
+        user_ids = args.split()
+        member_cache.invalidate(user_ids)
+        page_cache.invalidate_users(user_ids)
+
+
+def clear_caches():
+    # Changes notified while the listener wasn't connected are lost.
+    member_cache.clear()
+    page_cache.clear()
+
+# Last written profile of each DM conversation and our own cached user,
+# see update_dm_profile()
+dm_profiles = {}
+dm_profiles_lock = threading.Lock()
+current_user_cache = {'user': None, 'expires': 0}
+likes_refreshed = {}
+
+# When each group's archive last caught up with the API, for
+# groupme_sync_lag_seconds
+sync_caught_up = {}
+
+
+def page_likers(cur, group_id, messages):
+    """Look up the nickname and avatar of everyone who liked a message on the
+    page, in at most one query. Members who have left the group fall back to
+    their row in another group."""
+
+    user_ids = set(user_id for msg in messages for user_id in msg['likes'] or [])
+    generation = member_cache.generation()
+    likers = member_cache.get_many(group_id, user_ids)
+    missing = list(user_ids - set(likers))
+    if missing:
+        cur.execute(
+            "SELECT DISTINCT ON (user_id) user_id, nickname, avatar FROM members WHERE user_id = ANY(%s) ORDER BY user_id, group_id = %s DESC;",
+            (missing,
+             group_id))
+        # Unknown likers are cached too, until the sync job adds them.
+        found = dict((user_id, {'nickname': None, 'avatar': None})
+                     for user_id in missing)
+        found.update((row['user_id'], {'nickname': row['nickname'], 'avatar': row['avatar']})
+                     for row in cur.fetchall())
+        member_cache.put_many(group_id, found, generation)
+        likers.update(found)
+    return likers
+
+
+def message_row(msg, archive_id):
+    return (int(msg['id']),
+            msg['name'],
+            msg['text'] or '',
+            msg['avatar_url'],
+            datetime.fromtimestamp(msg['created_at']),
+            msg['user_id'],
+            archive_id)
+
+
+def sync_pages(cur, group_id, archive_id, type, before_id=None, after_id=None):
+    """Fetch messages older than ``before_id`` (or newer than ``after_id``)
+    and write them to the archive in batches of SYNC_BATCH_SIZE, committing
+    each batch together with the group's sync checkpoint so an interrupted
+    sync resumes after the last committed batch. Returns the number of newly
+    archived messages."""
+
+    batch = []
+    count = 0
+    stats = fetch_stats()
+    try:
+        for page in fetcher.pages(type, archive_id, before_id=before_id,
+                                  after_id=after_id, prefetch=FETCH_PREFETCH,
+                                  stats=stats):
+            batch.extend(page)
+            if len(batch) >= SYNC_BATCH_SIZE:
+                count += flush_batch(cur, group_id, archive_id, batch,
+                                     after_id is not None)
+                batch = []
+        if batch:
+            count += flush_batch(cur, group_id, archive_id, batch,
+                                 after_id is not None)
+    finally:
+        record_fetch(group_id, stats)
+    return count
+
+
+def fetch_stats():
+    return {'requests': 0, 'pages': 0, 'messages': 0, 'seconds': 0.0}
+
+
+def record_fetch(group_id, stats):
+    metrics.inc('groupme_sync_pages_total', stats['pages'], group=group_id)
+    metrics.inc('groupme_sync_api_requests_total', stats['requests'],
+                group=group_id)
+    metrics.inc('groupme_sync_api_seconds_total', stats['seconds'],
+                group=group_id)
+
+
+def flush_batch(cur, group_id, archive_id, batch, forward):
+    likes = [(int(msg['id']), user_id)
+             for msg in batch for user_id in set(msg['favorited_by'])]
+    inserted = bulk_insert_messages(
+        cur,
+        [message_row(msg, archive_id) for msg in batch],
+        likes,
+        [attachment_row(int(msg['id']), position, attachment)
+         for msg in batch for position, attachment in enumerate(msg['attachments'])])
+    update_timeline_bounds(cur, inserted)
+    update_message_days(cur, inserted, likes)
+    media_mirror.enqueue(cur, [msg['avatar_url'] for msg in batch] +
+                         [attachment.get('url') for msg in batch
+                          for attachment in msg['attachments']
+                          if attachment.get('type') in ('image', 'linked_image')])
+    if inserted:
+        cur.execute(
+            "UPDATE sync_state SET modified_at = now() WHERE group_id = %s;",
+            (group_id,))
+    newest_id = max(batch, key=lambda msg: int(msg['id']))['id']
+    if forward:
+        cur.execute(
+            "UPDATE sync_state SET newest_id = %s WHERE group_id = %s;",
+            (newest_id,
+             group_id))
+    else:
+        cur.execute(
+            "UPDATE sync_state SET oldest_id = %s, newest_id = COALESCE(newest_id, %s) WHERE group_id = %s;",
+            (min(batch, key=lambda msg: int(msg['id']))['id'],
+             newest_id,
+             group_id))
+    notify_messages(cur, group_id, [msg['id'] for msg in inserted])
+    check_lease(cur, group_id)
+    cur.connection.commit()
+    media_mirror.notify()
+    metrics.inc('groupme_sync_messages_total', len(inserted), group=group_id)
+    return len(inserted)
+
+
+def update_timeline_bounds(cur, inserted):
+    """Widen the timeline bounds of each group and member that got new
+    messages."""
+
+    bounds = {}
+    for msg in inserted:
+        created_at = msg['created_at']
+        for key in ((msg['group_id'], ''), (msg['group_id'], msg['user_id'])):
+            start, end, count = bounds.get(key, (created_at, created_at, 0))
+            bounds[key] = (min(start, created_at), max(end, created_at), count + 1)
+    cur.executemany(
+        "INSERT INTO timeline_bounds VALUES (%s, %s, %s, %s, %s) ON CONFLICT (group_id, user_id) DO UPDATE SET start_date = LEAST(timeline_bounds.start_date, EXCLUDED.start_date), end_date = GREATEST(timeline_bounds.end_date, EXCLUDED.end_date), message_count = timeline_bounds.message_count + EXCLUDED.message_count;",
+        [key + value for key, value in bounds.items()])
+
+
+def message_day(msg):
+    return msg['created_at'].astimezone(timezone.utc).date()
+
+
+def add_to_days(days, msg, liker=None, messages=0, likes=0):
+    """Count messages of ``msg``'s author, or ``likes`` by ``liker`` of the
+    message, in the message_days deltas ``days``."""
+
+    day = message_day(msg)
+    keys = [((msg['group_id'], '', day), (messages, likes, likes)),
+            ((msg['group_id'], msg['user_id'], day), (messages, likes, 0))]
+    if liker is not None:
+        keys.append(((msg['group_id'], liker, day), (0, 0, likes)))
+    for key, delta in keys:
+        days[key] = tuple(a + b for a, b in zip(days.get(key, (0, 0, 0)), delta))
+
+
+def write_message_days(cur, days):
+    cur.executemany(
+        "INSERT INTO message_days VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT (group_id, user_id, day) DO UPDATE SET message_count = message_days.message_count + EXCLUDED.message_count, likes_received = message_days.likes_received + EXCLUDED.likes_received, likes_given = message_days.likes_given + EXCLUDED.likes_given;",
+        [key + delta for key, delta in days.items()])
+
+
+def update_message_days(cur, inserted, likes):
+    """Add new messages, and the likes they were archived with, to the
+    per-day rollups of their group and members."""
+
+    days = {}
+    by_id = {}
+    for msg in inserted:
+        by_id[msg['id']] = msg
+        add_to_days(days, msg, messages=1)
+    for message_id, liker in likes:
+        if message_id in by_id:
+            add_to_days(days, by_id[message_id], liker, likes=1)
+    write_message_days(cur, days)
+
+
+def update_likes(cur, added, removed):
+    """Add and remove (message_id, user_id) likes of archived messages,
+    keeping the rollups in step. Only likes that actually appear or
+    disappear are counted. Returns the number of changed likes."""
+
+    changed = []
+    if removed:
+        cur.execute(
+            "DELETE FROM message_likes WHERE (message_id, user_id) IN (SELECT * FROM unnest(%s::bigint[], %s::text[])) RETURNING message_id, user_id;",
+            ([like[0] for like in removed],
+             [like[1] for like in removed]))
+        changed += [(row['message_id'], row['user_id'], -1) for row in cur.fetchall()]
+    if added:
+        cur.execute(
+            "INSERT INTO message_likes SELECT * FROM unnest(%s::bigint[], %s::text[]) ON CONFLICT DO NOTHING RETURNING message_id, user_id;",
+            ([like[0] for like in added],
+             [like[1] for like in added]))
+        changed += [(row['message_id'], row['user_id'], 1) for row in cur.fetchall()]
+    if not changed:
+        return 0
+
     cur.execute(
-        "SELECT nickname FROM members WHERE user_id = %s AND group_id = %s;", (id, group_id))
-    return cur.fetchone()['nickname']
+        "SELECT id, user_id, group_id, created_at FROM messages WHERE id = ANY(%s);",
+        (list(set(like[0] for like in changed)),))
+    by_id = dict((msg['id'], msg) for msg in cur.fetchall())
+    days = {}
+    for message_id, liker, delta in changed:
+        add_to_days(days, by_id[message_id], liker, likes=delta)
+    write_message_days(cur, days)
+    return len(changed)
+
+
+def refresh_likes(cur, group_id, archive_id, type):
+    """Re-fetch the newest messages of a group, going back LIKES_WINDOW_HOURS
+    hours or LIKES_WINDOW_MESSAGES messages, whichever comes first, and store
+    their changed likes in batches of SYNC_BATCH_SIZE. Costs one request per
+    page of recent messages however large the archive is. Returns the number
+    of changed likes."""
+
+    cutoff = time.time() - LIKES_WINDOW_HOURS * 3600
+    batch = []
+    seen = 0
+    changed = 0
+    stats = fetch_stats()
+    try:
+        # Only the first page is fetched ahead, the window usually ends early.
+        for page in fetcher.pages(type, archive_id, prefetch=1, stats=stats):
+            recent = [msg for msg in page if msg['created_at'] >= cutoff]
+            recent = recent[:LIKES_WINDOW_MESSAGES - seen]
+            batch.extend(recent)
+            seen += len(recent)
+            if len(batch) >= SYNC_BATCH_SIZE:
+                changed += flush_likes(cur, group_id, batch)
+                batch = []
+            if len(recent) < len(page) or seen >= LIKES_WINDOW_MESSAGES:
+                break
+        if batch:
+            changed += flush_likes(cur, group_id, batch)
+    finally:
+        record_fetch(group_id, stats)
+    return changed
+
+
+def flush_likes(cur, group_id, batch):
+    """Diff the likes of fetched messages against the archived ones and
+    commit the difference. Messages that aren't archived yet are skipped."""
+
+    fetched = dict((int(msg['id']), set(msg['favorited_by'])) for msg in batch)
+    cur.execute(
+        "SELECT id, ARRAY(SELECT user_id FROM message_likes WHERE message_id = messages.id) AS likes FROM messages WHERE id = ANY(%s);",
+        (list(fetched),))
+    added = []
+    removed = []
+    for row in cur.fetchall():
+        stored = set(row['likes'])
+        added += [(row['id'], user_id) for user_id in fetched[row['id']] - stored]
+        removed += [(row['id'], user_id) for user_id in stored - fetched[row['id']]]
+    changed = update_likes(cur, added, removed)
+    if changed:
+        cur.execute(
+            "UPDATE sync_state SET modified_at = now() WHERE group_id = %s;",
+            (group_id,))
+        notify_messages(cur, group_id, [like[0] for like in added + removed])
+    check_lease(cur, group_id)
+    cur.connection.commit()
+    return changed
 
-app.jinja_env.filters['member_avatar'] = member_avatar
 
-app.jinja_env.filters['member_nickname'] = member_nickname
+def timeline_dates(cur, group_id, user_id, where, params, tsquery):
+    """Return the formatted first and last message dates of a timeline. The
+    unfiltered bounds are a single timeline_bounds lookup; search results
+    fall back to aggregating the matching messages."""
 
-@app.template_test("image_attachment")
-def is_image_attachment(attachment):
-  return attachment.startswith("Image")
+    bounds = None
+    if not tsquery:
+        cur.execute(
+            "SELECT start_date, end_date FROM timeline_bounds WHERE group_id = %s AND user_id = %s;",
+            (group_id,
+             user_id))
+        bounds = cur.fetchone()
+    if not bounds:
+        cur.execute(
+            "SELECT min(created_at) AS start_date, max(created_at) AS end_date FROM messages WHERE " + where + ";",
+            params)
+        bounds = cur.fetchone()
+    return tuple(arrow.get(bounds[key]).format('MM/DD/YYYY') if bounds[key] else ''
+                 for key in ('start_date', 'end_date'))
+
+
+def current_user():
+    """Return the API key's own user, fetched at most once per
+    DM_PROFILE_TTL seconds."""
+
+    with dm_profiles_lock:
+        if current_user_cache['expires'] < time.time():
+            current_user_cache['user'] = groupy.User.get()
+            current_user_cache['expires'] = time.time() + DM_PROFILE_TTL
+        return current_user_cache['user']
+
+
+def update_dm_profile(cur, user_id, refresh):
+    """Keep the groups row and both members rows of a DM conversation up to
+    date without asking the API for anything but our own profile.
+
+    The other person's name and avatar are taken from their newest archived
+    message, re-read only when ``refresh`` is set (i.e. new messages arrived)
+    or the profile isn't cached yet. Rows are written only when the profile
+    differs from the cached one."""
+
+    me = current_user()
+    with dm_profiles_lock:
+        profile = dm_profiles.get(user_id, {})
+    them = profile.get('them')
+    if refresh or not them:
+        cur.execute(
+            "SELECT name, avatar_url FROM messages WHERE group_id = %s AND user_id = %s ORDER BY id DESC LIMIT 1;",
+            (user_id,
+             user_id))
+        row = cur.fetchone()
+        if row:
+            them = (row['name'], row['avatar_url'])
+        elif not them:
+            them = (user_id, None)
+    mine = (me.user_id, me.name, me.image_url)
+
+    if them != profile.get('them'):
+        cur.execute(
+            "INSERT INTO groups VALUES (%s, %s, %s, %s, %s) ON CONFLICT (id) DO UPDATE SET name = EXCLUDED.name, image_url = EXCLUDED.image_url, description = EXCLUDED.description;",
+            (them[0],
+             them[1],
+             '',
+             user_id,
+             'member'))
+        bulk_upsert_members(cur, [(user_id, them[0], them[1], user_id)])
+        notify_users(cur, [user_id])
+    if mine != profile.get('me'):
+        bulk_upsert_members(cur, [mine + (user_id,)])
+        notify_users(cur, [me.user_id])
+    cur.connection.commit()
+
+    with dm_profiles_lock:
+        dm_profiles[user_id] = {'them': them, 'me': mine}
+
+
+def load_directory():
+    return [{'id': group.id,
+             'name': group.name,
+             'image_url': group.image_url,
+             'description': group.description,
+             'message_count': group.message_count,
+             'members': [(member.user_id, member.nickname, member.image_url)
+                         for member in group.members()]}
+            for group in groupy.Group.list()]
+
+
+def store_directory(groups, members):
+    """Persist a directory refresh: list every group and DM partner in the
+    groups table and update the members of archived groups. This is also how
+    archived groups' names and members are kept up to date."""
+
+    with db_pool.connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        bulk_upsert_groups(cur,
+                           [(group['name'],
+                             group['image_url'],
+                             group['description'],
+                             group['id'],
+                             'group',
+                             False,
+                             group['message_count'])
+                            for group in groups] +
+                           [(member['nickname'],
+                             member['image_url'],
+                             '',
+                             member['user_id'],
+                             'member',
+                             False,
+                             None)
+                            for member in members])
+        cur.execute("SELECT id FROM groups WHERE type = 'group' AND archived;")
+        archived = set(row['id'] for row in cur.fetchall())
+        changed = bulk_upsert_members(cur,
+                                      [(user_id, nickname, image_url, group['id'])
+                                       for group in groups if group['id'] in archived
+                                       for user_id, nickname, image_url in group['members']])
+        media_mirror.enqueue(cur,
+                             [group['image_url'] for group in groups
+                              if group['id'] in archived] +
+                             [image_url for group in groups if group['id'] in archived
+                              for user_id, nickname, image_url in group['members']])
+        notify_users(cur, [row['user_id'] for row in changed])
+        conn.commit()
+        media_mirror.notify()
 
-def image_attachment_url(attachment):
-  return attachment.replace("Image(url='","").replace("')","")
 
-app.jinja_env.filters['image_attachment_url'] = image_attachment_url
+def restore_directory():
+    """The listing stored by the last refresh (of any process), served until
+    the directory's first refresh."""
 
+    with db_pool.connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute(
+            "SELECT id, name, image_url, description, message_count, type FROM groups;")
+        listed = cur.fetchall()
+    return ([dict(row, members=None) for row in listed if row['type'] == "group"],
+            [{'user_id': row['id'], 'nickname': row['name'], 'image_url': row['image_url']}
+             for row in listed if row['type'] == "member"])
 
-def handle_update_group(group_id, type, lock):
-    with lock:
+
+def archive_group(cur, group_id, type, entry):
+    """Mark a directory entry as archived, so it's synced from now on by one
+    of the syncing processes, see Leases. Returns False if it already was
+    archived."""
+
+    if type == "group":
+        profile = (entry['name'], entry['image_url'], entry['description'])
+    else:
+        profile = (entry['nickname'], entry['image_url'], '')
+    cur.execute(
+        "INSERT INTO groups VALUES (%s, %s, %s, %s, %s, true, %s) ON CONFLICT (id) DO UPDATE SET archived = true WHERE NOT groups.archived RETURNING id;",
+        profile + (group_id, type, entry.get('message_count')))
+    if cur.fetchone() is None:
+        cur.connection.rollback()
+        return False
+    if type == "group" and entry.get('members') is not None:
+        changed = bulk_upsert_members(cur,
+                                      [(user_id, nickname, image_url, group_id)
+                                       for user_id, nickname, image_url in entry['members']])
+        notify_users(cur, [row['user_id'] for row in changed])
+    cur.execute("SELECT pg_notify(%s, %s);", (ARCHIVED_CHANNEL, group_id))
+    cur.connection.commit()
+    if type == "group" and entry.get('members') is None:
+        # Listed from the database only: the next refresh adds the members.
+        directory.refresh()
+    return True
+
+
+def handle_update_group(group_id, type):
+    """Sync one archived group or DM conversation. Returns the number of new
+    messages archived. A group's name and members are kept up to date by the
+    directory refresh, see store_directory()."""
+
+    started = time.time()
+    ok = False
+    try:
+        new_messages = sync_group(group_id, type, started)
+        ok = True
+    finally:
+        seconds = time.time() - started
+        metrics.inc('groupme_sync_runs_total', group=group_id)
+        metrics.inc('groupme_sync_seconds_total', seconds, group=group_id)
+        if not ok:
+            metrics.inc('groupme_sync_failures_total', group=group_id)
+    if new_messages:
+        metrics.set('groupme_sync_messages_per_second', new_messages / seconds,
+                    group=group_id)
+    return new_messages
+
+
+def sync_group(group_id, type, started):
+    """The work of handle_update_group(). ``started`` is when the sync began,
+    recorded as the group's catch-up time once newer messages are in."""
+
+    with db_pool.connection() as conn:
         cur = conn.cursor(cursor_factory=RealDictCursor)
-        if type == "group":
-            group = groupy.Group.list().filter(id=group_id).first
-            cur.execute(
-                "INSERT INTO groups VALUES (%s, %s, %s, %s, %s) ON CONFLICT (id) DO UPDATE SET name = %s, image_url = %s, description = %s",
-                (group.name,
-                 group.image_url,
-                 group.description,
-                 group.id,
-                 type,
-                 group.name,
-                 group.image_url,
-                 group.description))
-            members = group.members()
-            cur.executemany("INSERT INTO members VALUES (%s, %s, %s, %s) ON CONFLICT (user_id, group_id) DO UPDATE SET nickname = %s, avatar = %s",
-                            [(member.user_id,
-                              member.nickname,
-                              member.image_url,
-                              group.id,
-                              member.nickname,
-                              member.image_url)
-                             for member in members])
-
-        elif type == "member":
-            members = groupy.Member.list()
-            group = members.filter(user_id=group_id).first
-            cur.execute(
-                "INSERT INTO groups VALUES (%s, %s, %s, %s, %s) ON CONFLICT (id) DO UPDATE SET name = %s, image_url = %s, description = %s",
-                (group.messages().filter(user_id=group.user_id)[0].name,
-                 group.image_url,
-                 '',
-                 group.user_id,
-                 type,
-                 group.messages().filter(user_id=group.user_id)[0].name,
-                 group.image_url,
-                 ''))
-            cur.execute("INSERT INTO members VALUES (%s, %s, %s, %s) ON CONFLICT (user_id, group_id) DO UPDATE SET nickname = %s, avatar = %s",
-                        (group.user_id,
-                         group.messages().filter(
-                             user_id=group.user_id)[0].name,
-                         group.image_url,
-                         group.user_id,
-                         group.messages().filter(
-                             user_id=group.user_id)[0].name,
-                         group.image_url)
-                        )
-            me = groupy.User.get()
-            cur.execute("INSERT INTO members VALUES (%s, %s, %s, %s) ON CONFLICT (user_id, group_id) DO UPDATE SET nickname = %s, avatar = %s",
-                        (me.user_id,
-                         me.name,
-                         me.image_url,
-                         group.user_id,
-                         me.name,
-                         me.image_url)
-                        )
-
-        messages = group.messages()
+        if type == "member":
+            # Make sure the conversation is listed before its (possibly long)
+            # first backfill starts.
+            update_dm_profile(cur, group_id, refresh=False)
+
+        archive_id = group_id
         cur.execute(
-            "SELECT id FROM messages WHERE group_id=%s ORDER BY id DESC LIMIT 1;",
+            "INSERT INTO sync_state SELECT %s, max(id)::text, min(id)::text, count(*) > 0 FROM messages WHERE group_id = %s ON CONFLICT (group_id) DO NOTHING;",
             (group_id,
-             ))
+             archive_id))
+        cur.execute(
+            "INSERT INTO timeline_bounds SELECT group_id, CASE WHEN GROUPING(user_id) = 1 THEN '' ELSE user_id END, min(created_at), max(created_at), count(*) FROM messages WHERE group_id = %s AND NOT EXISTS (SELECT 1 FROM timeline_bounds WHERE group_id = %s) GROUP BY GROUPING SETS ((group_id), (group_id, user_id)) ON CONFLICT DO NOTHING;",
+            (archive_id,
+             archive_id))
+        cur.execute("SELECT * FROM sync_state WHERE group_id = %s;", (group_id,))
+        state = cur.fetchone()
+        check_lease(cur, group_id)
+        conn.commit()
+
+        new_messages = 0
         try:
-            latest_id = cur.fetchone()['id']
+            # Catch up on anything posted since the newest archived message.
+            if state['newest_id']:
+                new_messages += sync_pages(cur, group_id, archive_id, type,
+                                           after_id=state['newest_id'])
+                sync_caught_up[group_id] = started
+
+            # Pick up likes of recent messages that changed since they were
+            # archived.
+            if (state['newest_id'] and time.time() - likes_refreshed.get(
+                    group_id, 0) >= LIKES_REFRESH_INTERVAL):
+                changed = refresh_likes(cur, group_id, archive_id, type)
+                likes_refreshed[group_id] = time.time()
+                metrics.inc('groupme_sync_likes_changed_total', changed,
+                            group=group_id)
+
+            # Resume (or start) the backfill from the oldest archived message.
+            if not state['backfill_complete']:
+                new_messages += sync_pages(cur, group_id, archive_id, type,
+                                           before_id=state['oldest_id'])
+                cur.execute(
+                    "UPDATE sync_state SET backfill_complete = true WHERE group_id = %s;",
+                    (group_id,))
+                check_lease(cur, group_id)
+                conn.commit()
+                if not state['newest_id']:
+                    # The first backfill started from the newest message.
+                    sync_caught_up[group_id] = started
+
+            if type == "member" and new_messages:
+                update_dm_profile(cur, group_id, refresh=True)
         except:
-            latest_id = None
-        x = 0
-        while messages.older():
-            try:
-                while messages.iolder():
-                    x += 1
-                    print(group_id, x)
-                    if messages.filter(id=latest_id):
-                        b = True
-                    if b:
-                        break
-                if b:
-                    break
-            except:
-                pass
-        if type == "group":
-            cur.executemany("INSERT INTO messages VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING",
-                            [(msg.id,
-                              msg.name,
-                              msg.text or '',
-                              [str(x) for x in msg.attachments],
-                                msg.avatar_url,
-                                msg.created_at,
-                                msg.user_id,
-                                group.id,
-                                msg.favorited_by)
-                                for msg in messages])
-        elif type == "member":
-            cur.executemany("INSERT INTO messages VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING",
-                            [(msg.id,
-                              msg.name,
-                              msg.text or '',
-                              [str(x) for x in msg.attachments],
-                                msg.avatar_url,
-                                msg.created_at,
-                                msg.user_id,
-                                group.user_id,
-                                msg.favorited_by)
-                                for msg in messages])
+            conn.rollback()
+            raise
 
-        conn.commit()
+        return new_messages
+
+fetcher = Fetcher(
+    groupy.config.API_KEY,
+    groupy.config.API_URL,
+    rate=FETCH_RATE,
+    burst=FETCH_BURST,
+    connections=FETCH_CONNECTIONS)
+
+directory = Directory(
+    load_directory,
+    store_directory,
+    restore=restore_directory,
+    ttl=DIRECTORY_TTL,
+    min_refresh=DIRECTORY_MIN_REFRESH)
+
+def forget_group(group_id):
+    """Drop the sync state of a group another process syncs from now on,
+    so its lag isn't reported from here any more."""
 
-        print("FINISHED ", group_id)
+    sync_caught_up.pop(group_id, None)
+    likes_refreshed.pop(group_id, None)
+    metrics.remove('groupme_sync_lag_seconds', group=group_id)
 
 
-def handle_update_group_async(group_id, type, lock):
-    thread = threading.Thread(
-        target=handle_update_group, args=(
-            group_id, type, lock))
-    thread.daemon = True
-    thread.start()
+sync_scheduler = SyncScheduler(
+    handle_update_group,
+    workers=SYNC_WORKERS,
+    interval=SYNC_INTERVAL,
+    max_interval=SYNC_MAX_INTERVAL,
+    on_remove=forget_group)
 
-cur.execute("SELECT id, type FROM groups;")
-groups = cur.fetchall()
-for group in groups:
-    print(group)
-    schedule.every(1).minutes.do(
-        handle_update_group_async,
-        group_id=group['id'],
-        type=group['type'],
-        lock=threading.Lock())
-    group_jobs.append(group['id'])
-schedule.run_all()
-schedule.run_continuously()
+
+def check_lease(cur, group_id):
+    """Make sure no other process has taken over the group being synced
+    before committing, see Leases.holds(). Syncs run without leases (e.g. by
+    the benchmarks) aren't checked."""
+
+    if group_leases.started and not group_leases.holds(cur, group_id):
+        raise LeaseLost(group_id)
+
+
+def start_sync():
+    """Sync this process's share of the archived groups, see Leases. Waits
+    for the database to be reachable."""
+
+    while True:
+        try:
+            # Groups archived while nobody listened are claimed on the next
+            # heartbeat anyway.
+            archived_listener.start()
+            # Restoring the directory checks out the pool's first connection,
+            # which migrates the schema before the leases' own connection
+            # uses it.
+            directory.start()
+            break
+        except Exception:
+            traceback.print_exc()
+            time.sleep(SYNC_HEARTBEAT)
+    group_leases.start()
+    sync_scheduler.start()
+    media_mirror.start()
+
+
+def create_app(database, user=None, password=None, sync=True):
+    """Point the app at a database and return it, e.g. for a WSGI server:
+    ``gunicorn 'app:create_app("database")'``. Nothing connects before the
+    first request, which also migrates the schema. With ``sync``, this
+    process also syncs its share of the archived groups, see start_sync()."""
+
+    global db_pool, media_mirror, changes_listener, archived_listener, group_leases
+    conn_args = {'database': database}
+    if user is not None:
+        conn_args['user'] = user
+    if password is not None:
+        conn_args['password'] = password
+    db_pool = ConnectionPool(
+        0,
+        DB_POOL_SIZE,
+        health_check_interval=DB_HEALTH_CHECK_INTERVAL,
+        on_query=record_query,
+        prepare=migrate,
+        **conn_args)
+    media_mirror = MediaMirror(db_pool, MEDIA_ROOT, MEDIA_HOSTS,
+                               workers=MEDIA_WORKERS,
+                               thumbnail_size=MEDIA_THUMBNAIL_SIZE)
+    changes_listener = Listener(CHANGES_CHANNEL, apply_change,
+                                reset=clear_caches, **conn_args)
+    group_leases = Leases(sync_scheduler, ttl=SYNC_LEASE_TTL,
+                          heartbeat=SYNC_HEARTBEAT, spread=SYNC_INTERVAL,
+                          **conn_args)
+    archived_listener = Listener(ARCHIVED_CHANNEL,
+                                 lambda payload: group_leases.wake(),
+                                 **conn_args)
+    if sync:
+        thread = threading.Thread(target=start_sync)
+        thread.daemon = True
+        thread.start()
+    return app
+
+
+def search_tsquery(query):
+    """Translate a search box query into a tsquery. Every word has to match,
+    "quoted phrases" have to match in order and a trailing * matches any word
+    starting with the prefix. Returns '' if the query has no searchable words."""
+
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', query):
+        words = re.findall(r'\w+', phrase or word)
+        if not words:
+            continue
+        if word.endswith('*'):
+            words[-1] += ':*'
+        terms.append('(' + ' <-> '.join(words) + ')')
+    return ' & '.join(terms)
+
+
+def search_filter(where, params, tsquery):
+    """Add the full-text search predicate to a timeline filter, if there is
+    anything to search for."""
+
+    if not tsquery:
+        return where, params
+    return (where + " AND " + SEARCH_VECTOR + " @@ to_tsquery(%s, %s)",
+            params + [SEARCH_CONFIG, tsquery])
+
+
+def timeline_page(cur, where, params, tsquery=''):
+    """Fetch the page of a timeline selected by the request's keyset cursor.
+
+    ``where`` (with ``params``) selects the timeline's messages. Pages are
+    addressed by message id rather than by offset: ``before`` gives the page
+    older than a message, ``after`` the page newer than it, and ``msg_id`` or
+    ``date`` the page ending at a message. Every page is a single index range
+    scan on the numeric message id, no matter how deep it is. Returns the
+    messages oldest first, the page size and the requested date (if any).
+
+    With ``sort=relevance`` and a search query, returns the ``page``th page
+    of matches ranked by relevance instead, most relevant first."""
+
+    num = min(max(int(request.args.get('num') if 'num' in request.args else 10), 1),
+              MAX_PAGE_SIZE)
+
+    if tsquery and request.args.get('sort') == 'relevance':
+        page = max(int(request.args.get('page') if 'page' in request.args else 1), 1)
+        cur.execute(
+            "SELECT " + MESSAGE_COLUMNS + " FROM messages WHERE " + where + " ORDER BY ts_rank(" +
+            SEARCH_VECTOR + ", to_tsquery(%s, %s)) DESC, id DESC OFFSET %s LIMIT %s;",
+            params + [SEARCH_CONFIG, tsquery, (page - 1) * num, num])
+        return cur.fetchall(), num, None
+
+    date_a = None
+    at = request.args.get('msg_id')
+
+    if 'date' in request.args:
+        date_a = arrow.get(request.args.get('date'), 'MM/DD/YYYY')
+        cur.execute(
+            "SELECT id FROM messages WHERE " + where +
+            " AND created_at >= %s ORDER BY created_at ASC, id ASC LIMIT 1;",
+            params + [date_a.datetime])
+        found = cur.fetchone()
+        at = found['id'] if found else None
+
+    if 'after' in request.args:
+        cur.execute(
+            "SELECT " + MESSAGE_COLUMNS + " FROM messages WHERE " + where +
+            " AND id > %s ORDER BY id ASC LIMIT %s;",
+            params + [int(request.args.get('after')), num])
+        data = cur.fetchall()
+        if len(data) == num:
+            return data, num, date_a
+    elif 'before' in request.args:
+        cur.execute(
+            "SELECT " + MESSAGE_COLUMNS + " FROM messages WHERE " + where +
+            " AND id < %s ORDER BY id DESC LIMIT %s;",
+            params + [int(request.args.get('before')), num])
+        data = cur.fetchall()
+        if len(data) == num:
+            return data[::-1], num, date_a
+        # Ran off the start of the timeline: show the first full page.
+        cur.execute(
+            "SELECT " + MESSAGE_COLUMNS + " FROM messages WHERE " + where +
+            " ORDER BY id ASC LIMIT %s;",
+            params + [num])
+        return cur.fetchall(), num, date_a
+    elif at:
+        cur.execute(
+            "SELECT " + MESSAGE_COLUMNS + " FROM messages WHERE " + where +
+            " AND id <= %s ORDER BY id DESC LIMIT %s;",
+            params + [int(at), num])
+        return cur.fetchall()[::-1], num, date_a
+
+    # Newest page, also used when an ``after`` page runs off the end.
+    cur.execute(
+        "SELECT " + MESSAGE_COLUMNS + " FROM messages WHERE " + where +
+        " ORDER BY id DESC LIMIT %s;",
+        params + [num])
+    return cur.fetchall()[::-1], num, date_a
+
+
+def timeline_messages(cur, group_id, where, params, tsquery=''):
+    """Render the messages of the page of a timeline selected by the request,
+    see timeline_page(). Pages selected by message id (rather than by date or
+    relevance) are served from page_cache when possible. Returns the rendered
+    page, with the ids of its first and last messages and its length for the
+    navigation buttons, and the requested date (if any)."""
+
+    key = None
+    if 'date' not in request.args and not (
+            tsquery and request.args.get('sort') == 'relevance'):
+        key = (request.path,) + tuple(request.args.get(arg) for arg in
+                                      ('before', 'after', 'msg_id', 'num', 'query'))
+        page = page_cache.get(key)
+        if page is not None:
+            return page, None
+
+    generation = page_cache.generation(group_id)
+    data, num, date_a = timeline_page(cur, where, params, tsquery)
+    likers = page_likers(cur, group_id, data)
+    page = {
+        'html': Markup(render_template("messages.html", messages=data,
+                                       likers=likers)),
+        'first': data[0]['id'] if data else None,
+        'last': data[-1]['id'] if data else None,
+        'count': len(data),
+        'num': num}
+
+    if key is not None:
+        low = high = None
+        if data:
+            # The page also changes if messages are archived past an end of
+            # the timeline it reached, or between it and its cursor.
+            cur.execute(
+                "SELECT EXISTS (SELECT 1 FROM messages WHERE " + where + " AND id < %s) AS older, EXISTS (SELECT 1 FROM messages WHERE " + where + " AND id > %s) AS newer;",
+                params + [page['first']] + params + [page['last']])
+            edges = cur.fetchone()
+            if edges['older']:
+                low = min([page['first']] + [int(request.args[arg]) for arg in
+                                             ('after',) if arg in request.args])
+            if edges['newer']:
+                high = max([page['last']] + [int(request.args[arg]) for arg in
+                                             ('before',) if arg in request.args])
+        page_cache.put(key, group_id, generation, page, len(page['html']),
+                       low, high, likers)
+    return page, date_a
+
+
+@app.template_filter('media')
+def media_filter(url, thumbnail=False):
+    """Link to the local copy of a mirrorable image or avatar."""
+
+    if not media_mirror.mirrorable(url):
+        return url
+    if thumbnail:
+        return url_for('media', url=url, thumbnail=1)
+    return url_for('media', url=url)
+
+
+@app.route("/media")
+def media():
+    """Serve the local copy of an image or avatar (or its thumbnail), or
+    redirect to GroupMe's copy until it has been mirrored. Local copies never
+    change, so browsers may cache them for MEDIA_MAX_AGE seconds."""
+
+    url = request.args.get('url', '')
+    if not media_mirror.mirrorable(url):
+        abort(404)
+    cur = get_cursor()
+    cur.execute("SELECT sha256, content_type, thumbnail FROM media WHERE url = %s;",
+                (url,))
+    row = cur.fetchone()
+    if row is None or row['sha256'] is None:
+        response = redirect(url)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    if 'thumbnail' in request.args and row['thumbnail']:
+        response = send_file(media_mirror.path(row['sha256'], True),
+                             mimetype='image/jpeg')
+    else:
+        response = send_file(media_mirror.path(row['sha256']),
+                             mimetype=row['content_type'])
+    response.headers['Cache-Control'] = 'public, max-age={0}, immutable'.format(
+        MEDIA_MAX_AGE)
+    return response
 
 
 @app.route("/")
 def index():
-    groups = groupy.Group.list()
-    members = groupy.Member.list()
+    # Never waits for the API: a stale listing is shown while the directory
+    # refreshes in the background.
+    groups, members = directory.listing()
     return render_template("index.html",
-                           groups=zip(
-                               [g.name for g in groups], [g.id for g in groups]),
-                           members=zip(
-                               [g.nickname for g in members], [g.user_id for g in members])
+                           groups=[(g['name'], g['id']) for g in groups],
+                           members=[(m['nickname'], m['user_id']) for m in members]
                            )
 
 
+@app.route("/db_pool")
+def db_pool_stats():
+    return app.response_class(json.dumps(db_pool.get_stats()),
+                              mimetype='application/json')
+
+
+@app.route("/sync_status")
+def sync_status():
+    stats = sync_scheduler.stats()
+    stats['fetcher'] = fetcher.get_stats()
+    stats['directory'] = directory.get_stats()
+    stats['pages'] = page_cache.get_stats()
+    stats['media'] = media_mirror.get_stats()
+    stats['leases'] = group_leases.get_stats()
+    return app.response_class(json.dumps(stats),
+                              mimetype='application/json')
+
+
+@app.route("/metrics")
+def metrics_page():
+    """Request, query and sync metrics, and the stats of the shared
+    components, in the Prometheus text format."""
+
+    now = time.time()
+    for group_id, caught_up in list(sync_caught_up.items()):
+        metrics.set('groupme_sync_lag_seconds', now - caught_up, group=group_id)
+    for prefix, stats in (('groupme_db_pool', db_pool.get_stats()),
+                          ('groupme_scheduler', sync_scheduler.stats()),
+                          ('groupme_fetcher', fetcher.get_stats()),
+                          ('groupme_directory', directory.get_stats()),
+                          ('groupme_page_cache', page_cache.get_stats()),
+                          ('groupme_media', media_mirror.get_stats()),
+                          ('groupme_leases', group_leases.get_stats())):
+        metrics.set_stats(prefix, stats, "See /sync_status and /db_pool.")
+    return app.response_class(
+        metrics.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def calendar(group_id, user_id):
+    """Message counts of a timeline per UTC day, or per week, month or year
+    with ``step``, optionally between the ``start`` and ``end`` dates
+    (YYYY-MM-DD). Read from the message_days rollup in one query."""
+
+    step = request.args.get('step', 'day')
+    if step not in ('day', 'week', 'month', 'year'):
+        return json_response({'error': 'step must be day, week, month or year'}, 400)
+    where = "group_id = %s AND user_id = %s"
+    params = [group_id, user_id]
+    for arg, condition in (('start', " AND day >= %s"), ('end', " AND day <= %s")):
+        if arg in request.args:
+            try:
+                params.append(datetime.strptime(request.args.get(arg), '%Y-%m-%d').date())
+            except ValueError:
+                return json_response({'error': arg + ' must be a YYYY-MM-DD date'}, 400)
+            where += condition
+
+    cur = get_cursor()
+    cur.execute(
+        "SELECT date_trunc(%s, day)::date AS day, sum(message_count) AS count FROM message_days WHERE " +
+        where + " GROUP BY 1 HAVING sum(message_count) > 0 ORDER BY 1;",
+        [step] + params)
+    days = [{'date': row['day'].isoformat(), 'count': int(row['count'])}
+            for row in cur.fetchall()]
+    return json_response({'step': step, 'days': days})
+
+
+def stats_totals(cur, group_id, user_id=None):
+    """Message and like totals of every member of a group (or of one), from
+    the message_days rollup. The group's own totals have user_id ''."""
+
+    where = "group_id = %s"
+    params = [group_id]
+    if user_id is not None:
+        where += " AND user_id IN ('', %s)"
+        params.append(user_id)
+    cur.execute(
+        "SELECT user_id, sum(message_count) AS messages, sum(likes_received) AS likes_received, sum(likes_given) AS likes_given FROM message_days WHERE " +
+        where + " GROUP BY user_id ORDER BY messages DESC, user_id;",
+        params)
+    return [dict(row,
+                 messages=int(row['messages']),
+                 likes_received=int(row['likes_received']),
+                 likes_given=int(row['likes_given']))
+            for row in cur.fetchall()]
+
+
+@app.route("/groups/<group_id>/stats")
+def group_stats(group_id):
+    cur = get_cursor()
+    sort = request.args.get('sort')
+    if sort not in ('likes_received', 'likes_given'):
+        sort = 'messages'
+    totals = stats_totals(cur, group_id)
+    group = [row for row in totals if row['user_id'] == '']
+    members = sorted([row for row in totals if row['user_id'] != ''],
+                     key=lambda row: row[sort], reverse=True)
+
+    cur.execute(
+        "SELECT user_id, nickname, avatar FROM members WHERE group_id = %s;", (group_id,))
+    profiles = dict((row['user_id'], row) for row in cur.fetchall())
+    cur.execute("SELECT * FROM groups WHERE id = %s;", (group_id,))
+
+    return render_template(
+        "stats.html",
+        group=cur.fetchone(),
+        group_id=group_id,
+        totals=group[0] if group else None,
+        members=members,
+        profiles=profiles,
+        sort=sort)
+
+
+@app.route("/groups/<group_id>/members/<member_id>/stats")
+def member_stats(group_id, member_id):
+    cur = get_cursor()
+    totals = dict((row['user_id'], row)
+                  for row in stats_totals(cur, group_id, member_id))
+    cur.execute(
+        "SELECT date_trunc('month', day)::date AS month, sum(message_count) AS messages, sum(likes_received) AS likes_received, sum(likes_given) AS likes_given FROM message_days WHERE group_id = %s AND user_id = %s GROUP BY 1 ORDER BY 1;",
+        (group_id,
+         member_id))
+    months = cur.fetchall()
+    cur.execute(
+        "SELECT * FROM members WHERE user_id = %s AND group_id = %s;",
+        (member_id,
+         group_id))
+    member = cur.fetchone()
+
+    return render_template(
+        "member_stats.html",
+        member=member or {},
+        id=member_id,
+        group_id=group_id,
+        totals=totals.get(member_id),
+        group_totals=totals.get(''),
+        months=months)
+
+
+@app.route("/groups/<group_id>/calendar")
+def group_calendar(group_id):
+    return calendar(group_id, '')
+
+
+@app.route("/groups/<group_id>/members/<member_id>/calendar")
+def member_calendar(group_id, member_id):
+    return calendar(group_id, member_id)
+
+
 @app.route("/add_group/<group_id>")
 def add_group(group_id):
-    print(group_id)
     type = request.args.get('type')
+    group = None
     if type == "group":
-        group = groupy.Group.list().filter(id=group_id).first
+        group = directory.group(group_id, wait=True)
     elif type == "member":
-        group = groupy.Member.list().filter(user_id=group_id).first
+        group = directory.member(group_id, wait=True)
     if not group:
         return render_template(
             "layout.html", message="Error! Group ID not found."), 404
-    if group_id in group_jobs:
+    if not archive_group(get_cursor(), group_id, type, group):
         return render_template(
             "layout.html",
             message="Error! Group already added.")
-    schedule.every(1).minutes.do(
-        handle_update_group_async,
-        group_id=group_id,
-        type=type,
-        lock=threading.Lock())
-    group_jobs.append(group_id)
-    schedule.run_all()
     if type == "group":
         return render_template(
             "layout.html",
             message="Fetching group history, please wait. <br> Number of messages: {0}. <br> Estimated time for processing: {1}.".format(
-                group.message_count,
+                group['message_count'],
                 verbose_timedelta(
                     timedelta(
-                        seconds=group.message_count /
+                        seconds=(group['message_count'] or 0) /
                         100 *
                         1.1))))
     elif type == "member":
@@ -320,334 +1406,283 @@ def add_group(group_id):
 
 @app.route("/groups/<group_id>/members/<member_id>")
 def member(group_id, member_id):
-    num = int(request.args.get('num') if 'num' in request.args else 10)
-
-    offset = int(request.args.get('offset')) if 'offset' in request.args else 0
-
+    cur = get_cursor()
     query = request.args.get('query') if 'query' in request.args else ''
 
-    msg_id = None
-
-    date_a = None
-
-    if 'date' in request.args:
-        date_a = arrow.get(request.args.get('date'), 'MM/DD/YYYY')
-        date = date_a.datetime
-        cur.execute(
-            "SELECT id FROM messages WHERE user_id=%s AND group_id=%s AND message ILIKE  '%%' || %s || '%%' AND created_at >= %s ORDER BY id ASC LIMIT 1;",
-            (member_id,
-             group_id,
-             query,
-             date))
-        msg_id = cur.fetchone()['id']
-
-    if 'msg_id' in request.args or msg_id:
-        if offset < 0:
-            msg_id = msg_id if msg_id else int(request.args.get('msg_id'))
-            cur.execute(
-                "SELECT id FROM messages WHERE user_id=%s AND group_id=%s AND id::bigint >= %s AND message ILIKE  '%%' || %s || '%%' ORDER BY id ASC OFFSET %s LIMIT 1;",
-                (member_id,
-                 group_id,
-                 msg_id,
-                 query,
-                 -offset))
-            try:
-                msg_id = cur.fetchone()['id']
-            except:
-                pass
-            offset = 0
-        msg_id = msg_id if msg_id else int(request.args.get('msg_id'))
-        cur.execute(
-            "SELECT * FROM messages WHERE user_id = %s AND group_id = %s AND id::bigint <= %s AND message ILIKE  '%%' || %s || '%%' ORDER BY id DESC OFFSET %s LIMIT %s;",
-            (member_id,
-             group_id,
-             msg_id,
-             query,
-             offset,
-             num))
-    else:
-        offset = max(offset, 0)
-        cur.execute(
-            "SELECT * FROM messages WHERE user_id = %s AND group_id = %s AND message ILIKE  '%%' || %s || '%%' ORDER BY id DESC OFFSET %s LIMIT %s;",
-            (member_id,
-             group_id,
-             query,
-             offset,
-             num))
-    data = cur.fetchall()
-
-    if not msg_id:
-        try:
-            msg_id = data[0]['id']
-        except:
-            pass
+    tsquery = search_tsquery(query)
+    where, params = search_filter(
+        "user_id = %s AND group_id = %s", [member_id, group_id], tsquery)
+    page, date_a = timeline_messages(cur, group_id, where, params, tsquery)
 
     cur.execute(
         "SELECT * FROM members WHERE user_id = %s AND group_id=%s;",
         (member_id,
          group_id))
-    print(
-        cur.mogrify(
-            "SELECT * FROM members WHERE user_id = %s AND group_id=%s;",
-            (member_id,
-             group_id)))
     member = cur.fetchall()
 
-    cur.execute(
-        "SELECT created_at, id FROM messages WHERE user_id = %s AND group_id=%s AND message ILIKE  '%%' || %s || '%%' ORDER BY created_at DESC LIMIT 1;",
-        (member_id,
-         group_id,
-         query))
-    end = cur.fetchone()
-    end_date = arrow.get(end['created_at']).format('MM/DD/YYYY')
-    end_id = end['id']
-
-    cur.execute(
-        "SELECT created_at, id FROM messages WHERE user_id = %s AND group_id=%s AND message ILIKE  '%%' || %s || '%%' ORDER BY created_at ASC LIMIT 1;",
-        (member_id,
-         group_id,
-         query))
-    start = cur.fetchone()
-    start_date = arrow.get(start['created_at']).format('MM/DD/YYYY')
-    start_id = start['id']
+    start_date, end_date = timeline_dates(
+        cur, group_id, member_id, where, params, tsquery)
 
     return render_template(
         "member.html",
-        messages=data[
-            ::-1],
+        page=page,
         member=(
             member[0] if len(member) > 0 else {}),
         id=member_id,
-        offset=offset,
-        num=num,
+        num=page['num'],
         query=query,
         group_id=group_id,
-        msg_id=msg_id,
         date=date_a.format('MM/DD/YYYY') if date_a else '',
         start_date=start_date,
-        end_date=end_date,
-        start_id=start_id,
-        end_id=end_id)
+        end_date=end_date)
 
 
 @app.route("/groups/<group_id>/members")
 def members(group_id):
-    cur.execute("SELECT * FROM members WHERE group_id = %s;", (group_id,))
-    members = cur.fetchall()
-    return render_template("members.html", members=members)
+    members = stream_query(
+        "SELECT * FROM members WHERE group_id = %s;", (group_id,))
+    return stream_template("members.html", members=members)
 
 
 @app.route("/groups")
 def groups():
-    cur.execute("SELECT * FROM groups WHERE type = 'group';")
-    groups = cur.fetchall()
-    return render_template("groups.html", groups=groups, type="Group")
+    groups = stream_query("SELECT * FROM groups WHERE type = 'group' AND archived;")
+    return stream_template("groups.html", groups=groups, type="Group")
 
 
 @app.route("/members")
 def p_members():
-    cur.execute("SELECT * FROM groups WHERE type = 'member';")
-    groups = cur.fetchall()
-    return render_template("groups.html", groups=groups, type="Member")
+    groups = stream_query("SELECT * FROM groups WHERE type = 'member' AND archived;")
+    return stream_template("groups.html", groups=groups, type="Member")
 
 
 @app.route("/groups/<group_id>")
 def group(group_id):
-    num = int(request.args.get('num') if 'num' in request.args else 10)
-
-    offset = int(request.args.get('offset') if 'offset' in request.args else 0)
-
+    cur = get_cursor()
     query = request.args.get('query') if 'query' in request.args else ''
 
-    msg_id = None
-
-    date_a = None
-
-    if 'date' in request.args:
-        date_a = arrow.get(request.args.get('date'), 'MM/DD/YYYY')
-        date = date_a.datetime
-        cur.execute(
-            "SELECT id FROM messages WHERE group_id=%s AND message ILIKE  '%%' || %s || '%%' AND created_at >= %s ORDER BY id ASC LIMIT 1;",
-            (group_id,
-             query,
-             date))
-        msg_id = cur.fetchone()['id']
-
-    if 'msg_id' in request.args or msg_id:
-        if offset < 0:
-            msg_id = msg_id if msg_id else int(request.args.get('msg_id'))
-            cur.execute(
-                "SELECT id FROM messages WHERE group_id=%s AND id::bigint >= %s AND message ILIKE  '%%' || %s || '%%' ORDER BY id ASC OFFSET %s LIMIT 1;",
-                (group_id,
-                 msg_id,
-                 query,
-                 -offset))
-            try:
-                msg_id = cur.fetchone()['id']
-            except:
-                pass
-            offset = 0
-        msg_id = msg_id if msg_id else int(request.args.get('msg_id'))
-        cur.execute(
-            "SELECT * FROM messages WHERE group_id=%s AND id::bigint <= %s AND message ILIKE  '%%' || %s || '%%' ORDER BY id DESC OFFSET %s LIMIT %s;",
-            (group_id,
-             msg_id,
-             query,
-             offset,
-             num))
-    else:
-        offset = max(offset, 0)
-        cur.execute(
-            "SELECT * FROM messages WHERE group_id=%s AND message ILIKE  '%%' || %s || '%%' ORDER BY id DESC OFFSET %s LIMIT %s;",
-            (group_id,
-             query,
-             offset,
-             num))
-    data = cur.fetchall()
-
-    if not msg_id:
-        try:
-            msg_id = data[0]['id']
-        except:
-            pass
+    tsquery = search_tsquery(query)
+    where, params = search_filter("group_id = %s", [group_id], tsquery)
+    page, date_a = timeline_messages(cur, group_id, where, params, tsquery)
 
     cur.execute("SELECT * FROM groups WHERE id = %s;", (group_id,))
     group = cur.fetchone()
 
-    cur.execute(
-        "SELECT created_at, id FROM messages WHERE group_id=%s AND message ILIKE  '%%' || %s || '%%' ORDER BY created_at DESC LIMIT 1;",
-        (group_id,
-         query))
-    end = cur.fetchone()
-    end_date = arrow.get(end['created_at']).format('MM/DD/YYYY')
-    end_id = end['id']
-
-    cur.execute(
-        "SELECT created_at, id FROM messages WHERE group_id=%s AND message ILIKE  '%%' || %s || '%%' ORDER BY created_at ASC LIMIT 1;",
-        (group_id,
-         query))
-    start = cur.fetchone()
-    start_date = arrow.get(start['created_at']).format('MM/DD/YYYY')
-    start_id = start['id']
+    start_date, end_date = timeline_dates(
+        cur, group_id, '', where, params, tsquery)
 
     return render_template(
         "group.html",
-        messages=data[
-            ::-1],
+        page=page,
         group=group,
         group_id=group_id,
-        offset=offset,
-        num=num,
+        num=page['num'],
         query=query,
-        msg_id=msg_id,
         date=date_a.format('MM/DD/YYYY') if date_a else '',
         start_date=start_date,
-        end_date=end_date,
-        start_id=start_id,
-        end_id=end_id)
+        end_date=end_date)
 
 
 @app.route("/messages")
 def messages():
-    cur.execute("SELECT * FROM private_members;")
-    private_members = cur.fetchall()
-    return render_template("groups.html", groups=private_members)
+    private_members = stream_query("SELECT * FROM private_members;")
+    return stream_template("groups.html", groups=private_members)
 
 
 @app.route("/messages/<group_id>")
 def private_messages(group_id):
-    num = int(request.args.get('num') if 'num' in request.args else 10)
-
-    offset = int(request.args.get('offset') if 'offset' in request.args else 0)
-
+    cur = get_cursor()
     query = request.args.get('query') if 'query' in request.args else ''
 
-    msg_id = None
-
-    date_a = None
-
-    if 'date' in request.args:
-        date_a = arrow.get(request.args.get('date'), 'MM/DD/YYYY')
-        date = date_a.datetime
-        cur.execute(
-            "SELECT id FROM messages WHERE group_id=%s AND message ILIKE  '%%' || %s || '%%' AND created_at >= %s ORDER BY id ASC LIMIT 1;",
-            (group_id,
-             query,
-             date))
-        msg_id = cur.fetchone()['id']
-
-    if 'msg_id' in request.args or msg_id:
-        if offset < 0:
-            msg_id = msg_id if msg_id else int(request.args.get('msg_id'))
-            cur.execute(
-                "SELECT id FROM messages WHERE group_id=%s AND id::bigint >= %s AND message ILIKE  '%%' || %s || '%%' ORDER BY id ASC OFFSET %s LIMIT 1;",
-                (group_id,
-                 msg_id,
-                 query,
-                 -offset))
-            try:
-                msg_id = cur.fetchone()['id']
-            except:
-                pass
-            offset = 0
-        msg_id = msg_id if msg_id else int(request.args.get('msg_id'))
-        cur.execute(
-            "SELECT * FROM messages WHERE group_id=%s AND id::bigint <= %s AND message ILIKE  '%%' || %s || '%%' ORDER BY id DESC OFFSET %s LIMIT %s;",
-            (group_id,
-             msg_id,
-             query,
-             offset,
-             num))
-    else:
-        offset = max(offset, 0)
-        cur.execute(
-            "SELECT * FROM messages WHERE group_id=%s AND message ILIKE  '%%' || %s || '%%' ORDER BY id DESC OFFSET %s LIMIT %s;",
-            (group_id,
-             query,
-             offset,
-             num))
-    data = cur.fetchall()
-
-    if not msg_id:
-        try:
-            msg_id = data[0]['id']
-        except:
-            pass
+    tsquery = search_tsquery(query)
+    where, params = search_filter("group_id = %s", [group_id], tsquery)
+    page, date_a = timeline_messages(cur, group_id, where, params, tsquery)
 
     cur.execute("SELECT * FROM groups WHERE id = %s;", (group_id,))
     group = cur.fetchone()
 
-    cur.execute(
-        "SELECT created_at, id FROM messages WHERE group_id=%s AND message ILIKE  '%%' || %s || '%%' ORDER BY created_at DESC LIMIT 1;",
-        (group_id,
-         query))
-    end = cur.fetchone()
-    end_date = arrow.get(end['created_at']).format('MM/DD/YYYY')
-    end_id = end['id']
-
-    cur.execute(
-        "SELECT created_at, id FROM messages WHERE group_id=%s AND message ILIKE  '%%' || %s || '%%' ORDER BY created_at ASC LIMIT 1;",
-        (group_id,
-         query))
-    start = cur.fetchone()
-    start_date = arrow.get(start['created_at']).format('MM/DD/YYYY')
-    start_id = start['id']
+    start_date, end_date = timeline_dates(
+        cur, group_id, '', where, params, tsquery)
 
     return render_template(
         "group.html",
-        messages=data[
-            ::-1],
+        page=page,
         group=group,
         group_id=group_id,
-        offset=offset,
-        num=num,
+        num=page['num'],
         query=query,
-        msg_id=msg_id,
         date=date_a.format('MM/DD/YYYY') if date_a else '',
         start_date=start_date,
-        end_date=end_date,
-        start_id=start_id,
-        end_id=end_id)
+        end_date=end_date)
+
+
+def api_messages(group_id, user_id=None):
+    """A page of a timeline as JSON, oldest message first. ``before`` and
+    ``after`` select the messages strictly older or newer than a message id
+    (the newest page without either), ``num`` the page size and ``query`` a
+    search. Pages are never padded or shifted like the HTML ones, so scripts
+    can follow the returned ``before`` cursor until it is null and poll with
+    the ``after`` cursor.
+
+    Responses carry an ETag and Last-Modified from the group's sync state,
+    which change whenever messages or likes are archived, and are answered
+    with 304 Not Modified before any timeline query runs."""
+
+    cur = get_cursor()
+    cur.execute(
+        "SELECT newest_id, modified_at FROM sync_state WHERE group_id = %s;",
+        (group_id,))
+    state = cur.fetchone()
+    if state is None:
+        return json_response({'error': 'not archived'}, 404)
+    etag = '{0}-{1}'.format(state['newest_id'] or '',
+                            int(state['modified_at'].timestamp() * 1000000))
+    # HTTP dates are naive UTC with whole seconds.
+    modified = state['modified_at'].astimezone(timezone.utc).replace(
+        tzinfo=None, microsecond=0)
+
+    if not is_resource_modified(request.environ, etag=etag,
+                                last_modified=modified):
+        response = app.response_class(status=304)
+    else:
+        try:
+            num = min(max(int(request.args.get('num', API_PAGE_SIZE)), 1),
+                      API_MAX_PAGE_SIZE)
+            after = int(request.args['after']) if 'after' in request.args else None
+            before = int(request.args['before']) if 'before' in request.args else None
+        except ValueError:
+            return json_response(
+                {'error': 'num, before and after must be integers'}, 400)
+
+        where = "group_id = %s"
+        params = [group_id]
+        if user_id is not None:
+            where += " AND user_id = %s"
+            params.append(user_id)
+        where, params = search_filter(
+            where, params, search_tsquery(request.args.get('query', '')))
+
+        if after is not None:
+            cur.execute(
+                "SELECT " + MESSAGE_COLUMNS + " FROM messages WHERE " + where +
+                " AND id > %s ORDER BY id ASC LIMIT %s;",
+                params + [after, num])
+            data = cur.fetchall()
+        else:
+            cur.execute(
+                "SELECT " + MESSAGE_COLUMNS + " FROM messages WHERE " + where +
+                ("" if before is None else " AND id < %s") +
+                " ORDER BY id DESC LIMIT %s;",
+                params + ([] if before is None else [before]) + [num])
+            data = cur.fetchall()[::-1]
+
+        if data:
+            older = data[0]['id'] if after is not None or len(data) == num else None
+            newer = data[-1]['id']
+        else:
+            older = None
+            newer = after
+        # Ids are strings, as in the GroupMe API: they don't fit in a double.
+        response = json_response({
+            'messages': [{
+                'id': str(msg['id']),
+                'user_id': msg['user_id'],
+                'name': msg['name'],
+                'avatar_url': msg['avatar_url'],
+                'text': msg['message'],
+                'created_at': msg['created_at'],
+                'likes': msg['likes'],
+                'attachments': msg['attachments']} for msg in data],
+            'before': None if older is None else str(older),
+            'after': None if newer is None else str(newer)})
+
+    response.set_etag(etag)
+    response.last_modified = modified
+    # Cached copies must be revalidated, which is what makes polling cheap.
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route("/api/groups/<group_id>/messages")
+def api_group_messages(group_id):
+    return api_messages(group_id)
+
+
+@app.route("/api/groups/<group_id>/members/<member_id>/messages")
+def api_member_messages(group_id, member_id):
+    return api_messages(group_id, member_id)
+
+
+@app.route("/api/messages/<group_id>")
+def api_private_messages(group_id):
+    return api_messages(group_id)
+
+
+def sync_worker(database, user=None, password=None, port=None):
+    """Sync this process's share of the archived groups until interrupted or
+    terminated, then hand them over to the other syncing processes."""
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    create_app(database, user, password, sync=False)
+    if port:
+        thread = threading.Thread(target=app.run, kwargs={'port': port})
+        thread.daemon = True
+        thread.start()
+    try:
+        start_sync()
+        while True:
+            time.sleep(3600)
+    finally:
+        # Ctrl-C reaches every worker, and then the parent terminates them.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        group_leases.release_all()
+
+
+def sync_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='app.py sync',
+        description="Sync the archived groups without serving the archive. "
+        "Every process syncing a database, on this host or another, syncs "
+        "its share of the groups and takes over those of processes that "
+        "stopped.")
+    parser.add_argument('database')
+    parser.add_argument('user', nargs='?')
+    parser.add_argument('password', nargs='?')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=1,
+        help="number of sync processes to run (default: 1)")
+    parser.add_argument(
+        '-p', '--port', type=int,
+        help="also serve the app (e.g. /metrics and /sync_status) on this "
+        "local port, and the following ones for further workers")
+    args = parser.parse_args(argv)
+
+    if args.workers == 1:
+        sync_worker(args.database, args.user, args.password, args.port)
+        return
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=sync_worker,
+                               args=(args.database, args.user, args.password,
+                                     args.port + i if args.port else None))
+               for i in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            worker.terminate()
+
 
 if __name__ == "__main__":
+    # Exports and imports run instead of the app, see transfer.py, and so
+    # does a sync-only worker.
+    if len(sys.argv) > 1 and sys.argv[1] in ('export', 'import'):
+        sys.exit(transfer.main(sys.argv[1:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'sync':
+        sys.exit(sync_main(sys.argv[2:]))
+    create_app(*sys.argv[1:4])
     app.run()
@@ -0,0 +1,112 @@
+# *------------------------------------------------------------------------------*
+# GroupMe Archiver: A web application to store and display GroupMe group histories
+# Copyright (C) 2016 Jordan Buchman
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# *------------------------------------------------------------------------------*
+
+# Times the sync job's full backfill of one group from benchmarks.mock_groupme,
+# through the app's own sync code. The app is imported, so its background
+# jobs run meanwhile; use an empty database.
+#
+#   python -m benchmarks.backfill database [username] [password]
+#       [--messages 1000000] [--rate N] [--latency S] [-o FILE]
+
+import argparse
+import resource
+import sys
+import time
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from benchmarks import results
+from benchmarks.mock_groupme import MockGroupMe, serve, use_mock
+
+GROUP_ID = '1'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time a full backfill from the mock GroupMe API.")
+    parser.add_argument('database')
+    parser.add_argument('user', nargs='?')
+    parser.add_argument('password', nargs='?')
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--members', type=int, default=50)
+    parser.add_argument('--likes', type=float, default=1.5)
+    parser.add_argument('--attachments', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rate', type=float, default=1000,
+                        help="API requests per second (the app's own limit is FETCH_RATE)")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds the mock API takes per request")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('-o', '--output', help="write the results as JSON")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(
+        database=args.database,
+        user=args.user,
+        password=args.password)
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('messages') IS NOT NULL;")
+    if cur.fetchone()[0]:
+        cur.execute("SELECT EXISTS (SELECT 1 FROM messages WHERE group_id = %s);",
+                    (GROUP_ID,))
+        if cur.fetchone()[0]:
+            print("Group {0} is already archived in {1}, use an empty database".format(
+                GROUP_ID, args.database), file=sys.stderr)
+            return 1
+    conn.rollback()
+
+    mock = MockGroupMe(1, args.messages, args.members, args.error_rate,
+                       args.latency, args.likes, args.attachments, args.seed)
+    use_mock(serve(mock, args.port))
+    import app
+    # Sync only the benchmark's group, from this thread.
+    app.create_app(args.database, args.user, args.password, sync=False)
+    # The mock's image URLs don't exist, so don't queue them for mirroring.
+    app.media_mirror.hosts = set()
+    app.fetcher.bucket.rate = app.fetcher.bucket.burst = args.rate
+
+    entry = app.directory.group(GROUP_ID, wait=True)
+    with app.db_pool.connection() as db:
+        app.archive_group(db.cursor(cursor_factory=RealDictCursor), GROUP_ID,
+                          'group', entry)
+
+    fetched = app.fetcher.get_stats()
+    start = time.perf_counter()
+    messages = app.handle_update_group(GROUP_ID, 'group')
+    elapsed = time.perf_counter() - start
+    stats = app.fetcher.get_stats()
+    result = {
+        'messages': messages,
+        'seconds': elapsed,
+        'messages_per_second': messages / elapsed,
+        'api_requests': stats['requests'] - fetched['requests'],
+        'api_seconds': stats['seconds'] - fetched['seconds'],
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    print("backfill {0} messages {1:.2f} s {2:.0f} messages/s, {3} API requests, "
+          "{4:.0f} MB peak memory".format(
+              messages, elapsed, result['messages_per_second'],
+              result['api_requests'], result['max_rss_mb']))
+    if args.output:
+        params = dict(vars(args))
+        del params['password'], params['output']
+        results.write(args.output, 'backfill', params, {'backfill': result}, conn)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
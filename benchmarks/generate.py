@@ -0,0 +1,143 @@
+# *------------------------------------------------------------------------------*
+# GroupMe Archiver: A web application to store and display GroupMe group histories
+# Copyright (C) 2016 Jordan Buchman
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# *------------------------------------------------------------------------------*
+
+# Fills a database with synthetic archived groups for the load benchmarks:
+# the same messages benchmarks.mock_groupme serves, with their likes,
+# attachments, members, rollups and sync state, as if they had been synced.
+# The same arguments always generate the same archive, and running it again
+# only adds what is missing.
+#
+#   python -m benchmarks.generate database [username] [password] [--groups N]
+#       [--messages N] [--members N] [--likes N] [--attachments F] [--seed N]
+
+import argparse
+import time
+from datetime import datetime
+
+import psycopg2
+
+from benchmarks import results
+from benchmarks.mock_groupme import MockGroupMe
+from ingest import (attachment_row, bulk_insert_messages, bulk_upsert_groups,
+                    bulk_upsert_members)
+from schema import migrate
+from transfer import rebuild_rollups
+
+# Messages written per transaction
+GENERATE_BATCH_SIZE = 10000
+
+
+def message_rows(mock, group_id, start, end):
+    """Message, like and attachment rows of messages ``start`` to ``end``,
+    as the sync job would write them."""
+
+    rows, likes, attachments = [], [], []
+    for i in range(start, end):
+        msg = mock.message(group_id, i)
+        id = int(msg['id'])
+        rows.append((id,
+                     msg['name'],
+                     msg['text'],
+                     msg['avatar_url'],
+                     datetime.fromtimestamp(msg['created_at']),
+                     msg['user_id'],
+                     group_id))
+        likes.extend((id, user_id) for user_id in msg['favorited_by'])
+        attachments.extend(attachment_row(id, position, attachment)
+                           for position, attachment in enumerate(msg['attachments']))
+    return rows, likes, attachments
+
+
+def generate_group(conn, mock, group_id):
+    """Write one group and return the number of messages added."""
+
+    cur = conn.cursor()
+    bulk_upsert_groups(cur, [('Group ' + group_id, None, '', group_id, 'group',
+                              True, mock.messages)])
+    cur.execute("UPDATE groups SET archived = true WHERE id = %s;", (group_id,))
+    bulk_upsert_members(cur, [(mock.user_id(m), 'Member ' + mock.user_id(m),
+                               None, group_id)
+                              for m in range(mock.members)])
+    conn.commit()
+
+    added = 0
+    for start in range(0, mock.messages, GENERATE_BATCH_SIZE):
+        rows, likes, attachments = message_rows(
+            mock, group_id, start, min(start + GENERATE_BATCH_SIZE, mock.messages))
+        added += len(bulk_insert_messages(cur, rows, likes, attachments))
+        conn.commit()
+
+    base = mock.base(group_id, False)
+    cur.execute(
+        "INSERT INTO sync_state (group_id, newest_id, oldest_id, backfill_complete) VALUES (%s, %s, %s, true) "
+        "ON CONFLICT (group_id) DO UPDATE SET newest_id = EXCLUDED.newest_id, oldest_id = EXCLUDED.oldest_id, "
+        "backfill_complete = true, modified_at = now();",
+        (group_id, str(base + mock.messages - 1), str(base)))
+    rebuild_rollups(cur, group_id)
+    conn.commit()
+    return added
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fill a database with synthetic archived groups.")
+    parser.add_argument('database')
+    parser.add_argument('user', nargs='?')
+    parser.add_argument('password', nargs='?')
+    parser.add_argument('--groups', type=int, default=3)
+    parser.add_argument('--messages', type=int, default=100000,
+                        help="messages per group")
+    parser.add_argument('--members', type=int, default=50,
+                        help="members per group")
+    parser.add_argument('--likes', type=float, default=1.5,
+                        help="average likes per message")
+    parser.add_argument('--attachments', type=float, default=0.05,
+                        help="fraction of messages with an attachment")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help="write the results as JSON")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(
+        database=args.database,
+        user=args.user,
+        password=args.password)
+    migrate(conn)
+    mock = MockGroupMe(args.groups, args.messages, args.members,
+                       likes=args.likes, attachments=args.attachments,
+                       seed=args.seed)
+
+    timings = {}
+    for group in range(1, args.groups + 1):
+        start = time.perf_counter()
+        added = generate_group(conn, mock, str(group))
+        elapsed = time.perf_counter() - start
+        timings['group ' + str(group)] = {
+            'messages': added,
+            'seconds': elapsed,
+            'messages_per_second': added / elapsed}
+        print("group {0:<6} {1:>9} messages {2:>8.2f} s {3:>12.0f} messages/s".format(
+            group, added, elapsed, added / elapsed))
+
+    conn.autocommit = True
+    conn.cursor().execute("ANALYZE;")
+    if args.output:
+        params = dict(vars(args))
+        del params['password'], params['output']
+        results.write(args.output, 'generate', params, timings, conn)
+
+if __name__ == "__main__":
+    main()
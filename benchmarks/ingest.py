@@ -0,0 +1,180 @@
+# *------------------------------------------------------------------------------*
+# GroupMe Archiver: A web application to store and display GroupMe group histories
+# Copyright (C) 2016 Jordan Buchman
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# *------------------------------------------------------------------------------*
+
+# Compares message/member ingestion throughput of per-row executemany inserts
+# against the COPY + merge path in ingest.py. Runs entirely in temporary
+# tables, so it is safe to point at a database holding a real archive.
+#
+#   python -m benchmarks.ingest database [username] [password] [--rows N]
+#       [-o FILE]
+
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+import psycopg2
+
+from benchmarks import results
+from ingest import attachment_row, bulk_insert_messages, bulk_upsert_members
+
+
+def create_tables(cur):
+    cur.execute("""
+      CREATE TEMP TABLE messages(
+        id bigint PRIMARY KEY,
+        name text,
+        message text,
+        avatar_url text,
+        created_at timestamp with time zone,
+        user_id text,
+        group_id text
+      )
+    """)
+    cur.execute("""
+      CREATE TEMP TABLE message_likes(
+        message_id bigint REFERENCES messages (id) ON DELETE CASCADE,
+        user_id text,
+        PRIMARY KEY (message_id, user_id)
+      )
+    """)
+    cur.execute("""
+      CREATE TEMP TABLE message_attachments(
+        message_id bigint REFERENCES messages (id) ON DELETE CASCADE,
+        position smallint,
+        type text NOT NULL,
+        url text,
+        name text,
+        lat double precision,
+        lng double precision,
+        user_ids text[],
+        data jsonb,
+        PRIMARY KEY (message_id, position)
+      )
+    """)
+    cur.execute("""
+      CREATE TEMP TABLE members(
+        user_id text,
+        nickname text,
+        avatar text,
+        group_id text,
+        UNIQUE (user_id, group_id)
+      )
+    """)
+
+
+def fake_messages(count, group_id, users):
+    """Yield (message row, like rows, attachment rows) triples."""
+
+    start = datetime(2016, 1, 1)
+    for i in range(count):
+        user = random.choice(users)
+        id = 100000000000000000 + i
+        attachments = ([{'type': 'image', 'url': 'https://i.groupme.com/{0}.png'.format(i)}]
+                       if i % 10 == 0 else [])
+        yield ((id,
+                'User ' + user,
+                'message {0}\twith "quotes", \\backslashes\\ and\nnewlines'.format(i),
+                'https://i.groupme.com/avatar/' + user,
+                start + timedelta(seconds=i),
+                user,
+                group_id),
+               [(id, liker) for liker in random.sample(users, random.randint(0, 3))],
+               [attachment_row(id, position, attachment)
+                for position, attachment in enumerate(attachments)])
+
+
+def fake_members(count, group_id):
+    return [(str(i), 'User {0}'.format(i), None, group_id) for i in range(count)]
+
+
+def executemany_messages(cur, messages):
+    cur.executemany(
+        "INSERT INTO messages VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING",
+        [row for row, likes, attachments in messages])
+    cur.executemany(
+        "INSERT INTO message_likes VALUES (%s, %s) ON CONFLICT DO NOTHING",
+        [like for row, likes, attachments in messages for like in likes])
+    cur.executemany(
+        "INSERT INTO message_attachments VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING",
+        [attachment for row, likes, attachments in messages for attachment in attachments])
+
+
+def copy_messages(cur, messages):
+    bulk_insert_messages(
+        cur,
+        [row for row, likes, attachments in messages],
+        [like for row, likes, attachments in messages for like in likes],
+        [attachment for row, likes, attachments in messages for attachment in attachments])
+
+
+def executemany_members(cur, rows):
+    cur.executemany("INSERT INTO members VALUES (%s, %s, %s, %s) ON CONFLICT (user_id, group_id) DO UPDATE SET nickname = %s, avatar = %s",
+                    [row + (row[1], row[2]) for row in rows])
+
+
+def run(conn, name, load, rows, batch_size):
+    cur = conn.cursor()
+    cur.execute("TRUNCATE messages, message_likes, message_attachments, members;")
+    conn.commit()
+    start = time.perf_counter()
+    for i in range(0, len(rows), batch_size):
+        load(cur, rows[i:i + batch_size])
+        conn.commit()
+    elapsed = time.perf_counter() - start
+    print("{0:<24} {1:>9} rows {2:>8.2f} s {3:>12.0f} rows/s".format(
+        name, len(rows), elapsed, len(rows) / elapsed))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('database')
+    parser.add_argument('user', nargs='?')
+    parser.add_argument('password', nargs='?')
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--members', type=int, default=500)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('-o', '--output', help="write the results as JSON")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(
+        database=args.database,
+        user=args.user,
+        password=args.password)
+    create_tables(conn.cursor())
+    conn.commit()
+
+    users = [str(i) for i in range(args.members)]
+    messages = list(fake_messages(args.rows, 'benchmark', users))
+    members = fake_members(args.members, 'benchmark')
+
+    timings = {}
+    for name, load, rows in (('messages executemany', executemany_messages, messages),
+                             ('messages copy', copy_messages, messages),
+                             ('members executemany', executemany_members, members),
+                             ('members copy', bulk_upsert_members, members)):
+        elapsed = run(conn, name, load, rows, args.batch_size)
+        timings[name] = {'rows': len(rows), 'seconds': elapsed,
+                         'rows_per_second': len(rows) / elapsed}
+    if args.output:
+        params = dict(vars(args))
+        del params['password'], params['output']
+        results.write(args.output, 'ingest', params, timings, conn)
+
+if __name__ == "__main__":
+    main()
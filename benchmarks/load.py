@@ -0,0 +1,238 @@
+# *------------------------------------------------------------------------------*
+# GroupMe Archiver: A web application to store and display GroupMe group histories
+# Copyright (C) 2016 Jordan Buchman
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# *------------------------------------------------------------------------------*
+
+# Scripted load against a running app: every scenario sends a number of
+# requests from a few concurrent clients and reports throughput and latency
+# percentiles, plus the SQL queries per request from the app's /metrics.
+# Scenarios pick their pages at random from the group's history, the same
+# ones for the same --seed.
+#
+#   python -m benchmarks.load http://localhost:5000 --group 1 [--requests N]
+#       [--concurrency N] [--scenario NAME ...] [-o FILE]
+#
+# Use a group from benchmarks.generate for comparable runs.
+
+import argparse
+import json
+import random
+import re
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from benchmarks import results
+from benchmarks.mock_groupme import WORDS
+
+# Seconds to wait for a page
+REQUEST_TIMEOUT = 60
+
+
+class Timeline:
+    """The bounds and members of a group, looked up through the JSON API,
+    which the scenarios pick their pages from."""
+
+    def __init__(self, url, group_id):
+        self.url = url
+        self.group_id = group_id
+        api = '/api/groups/{0}/messages'.format(group_id)
+        oldest = get_json(url + api + '?after=0&num=1')['messages']
+        newest = get_json(url + api + '?num=1000')['messages']
+        if not oldest or not newest:
+            raise ValueError("Group {0} has no archived messages".format(group_id))
+        self.oldest_id = int(oldest[0]['id'])
+        self.newest_id = int(newest[-1]['id'])
+        self.start = parse_time(oldest[0]['created_at'])
+        self.end = parse_time(newest[-1]['created_at'])
+        self.members = sorted(set(msg['user_id'] for msg in newest))
+
+    def random_id(self, rng):
+        return rng.randint(self.oldest_id, self.newest_id)
+
+    def random_date(self, rng):
+        return datetime.fromtimestamp(rng.uniform(self.start, self.end),
+                                      timezone.utc).strftime('%m/%d/%Y')
+
+
+def parse_time(value):
+    return datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S').replace(
+        tzinfo=timezone.utc).timestamp()
+
+
+def get_json(url):
+    with urllib.request.urlopen(url, timeout=REQUEST_TIMEOUT) as r:
+        return json.loads(r.read().decode())
+
+
+def newest(timeline, rng):
+    return '/groups/{0}'.format(timeline.group_id)
+
+
+def deep_pagination(timeline, rng):
+    """A page anywhere in the history, as reached by paging back."""
+
+    return '/groups/{0}?before={1}'.format(timeline.group_id,
+                                           timeline.random_id(rng))
+
+
+def api_pagination(timeline, rng):
+    return '/api/groups/{0}/messages?before={1}'.format(timeline.group_id,
+                                                        timeline.random_id(rng))
+
+
+def search(timeline, rng):
+    """Single words, from very common to rare, some phrases and prefixes."""
+
+    kind = rng.random()
+    if kind < 0.6:
+        query = rng.choice(WORDS)
+    elif kind < 0.8:
+        query = '"{0} {1}"'.format(rng.choice(WORDS), rng.choice(WORDS))
+    else:
+        query = rng.choice(WORDS)[:3] + '*'
+    return '/groups/{0}?{1}'.format(timeline.group_id,
+                                    urllib.parse.urlencode({'query': query}))
+
+
+def date_jump(timeline, rng):
+    return '/groups/{0}?{1}'.format(
+        timeline.group_id,
+        urllib.parse.urlencode({'date': timeline.random_date(rng)}))
+
+
+def member_timeline(timeline, rng):
+    """A member's newest page or one further back."""
+
+    path = '/groups/{0}/members/{1}'.format(timeline.group_id,
+                                            rng.choice(timeline.members))
+    if rng.random() < 0.5:
+        path += '?before={0}'.format(timeline.random_id(rng))
+    return path
+
+
+SCENARIOS = (newest, deep_pagination, api_pagination, search, date_jump,
+             member_timeline)
+
+
+def fetch(url):
+    """Return the seconds it took to receive the whole response, and its
+    status."""
+
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=REQUEST_TIMEOUT) as r:
+            r.read()
+            status = r.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except (urllib.error.URLError, OSError):
+        status = None
+    return time.perf_counter() - start, status
+
+
+def query_counts(url):
+    """Total SQL queries and requests per endpoint from /metrics, or {} if
+    the app doesn't report them."""
+
+    try:
+        with urllib.request.urlopen(url + '/metrics', timeout=REQUEST_TIMEOUT) as r:
+            text = r.read().decode()
+    except (urllib.error.URLError, OSError):
+        return {}
+    counts = {}
+    for name, endpoint, value in re.findall(
+            r'^groupme_http_request_queries_(sum|count)\{endpoint="([^"]*)"\} (\S+)$',
+            text, re.M):
+        counts.setdefault(endpoint, {})[name] = float(value)
+    return counts
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run(url, timeline, scenario, requests, concurrency, seed):
+    rng = random.Random('{0}:{1}'.format(seed, scenario.__name__))
+    paths = [scenario(timeline, rng) for _ in range(requests)]
+    before = query_counts(url)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        responses = list(pool.map(fetch, [url + path for path in paths]))
+    elapsed = time.perf_counter() - start
+    after = query_counts(url)
+
+    latencies = sorted(seconds for seconds, status in responses)
+    result = {
+        'requests': requests,
+        'errors': sum(1 for seconds, status in responses
+                      if status is None or status >= 400),
+        'seconds': elapsed,
+        'requests_per_second': requests / elapsed,
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p90_ms': percentile(latencies, 0.9) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000}
+    # The scenario's requests are the only ones the app served meanwhile,
+    # apart from the /metrics request itself.
+    queries = sum(counts.get('sum', 0) - before.get(endpoint, {}).get('sum', 0)
+                  for endpoint, counts in after.items() if endpoint != 'metrics_page')
+    served = sum(counts.get('count', 0) - before.get(endpoint, {}).get('count', 0)
+                 for endpoint, counts in after.items() if endpoint != 'metrics_page')
+    if served:
+        result['queries_per_request'] = queries / served
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run scripted load scenarios against a running app.")
+    parser.add_argument('url', help="e.g. http://localhost:5000")
+    parser.add_argument('--group', required=True, help="id of an archived group")
+    parser.add_argument('--requests', type=int, default=200,
+                        help="requests per scenario")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--scenario', action='append',
+                        choices=[scenario.__name__ for scenario in SCENARIOS],
+                        help="run only these scenarios")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help="write the results as JSON")
+    args = parser.parse_args()
+
+    url = args.url.rstrip('/')
+    timeline = Timeline(url, args.group)
+    timings = {}
+    for scenario in SCENARIOS:
+        if args.scenario and scenario.__name__ not in args.scenario:
+            continue
+        result = timings[scenario.__name__] = run(
+            url, timeline, scenario, args.requests, args.concurrency, args.seed)
+        print("{0:<16} {1:>8.1f} req/s  p50 {2:>8.1f} ms  p99 {3:>8.1f} ms  "
+              "{4:>6} errors  {5:>6} queries/req".format(
+                  scenario.__name__, result['requests_per_second'],
+                  result['p50_ms'], result['p99_ms'], result['errors'],
+                  '{0:.1f}'.format(result['queries_per_request'])
+                  if 'queries_per_request' in result else '-'))
+    if args.output:
+        params = dict(vars(args))
+        del params['output']
+        results.write(args.output, 'load', params, timings)
+
+if __name__ == "__main__":
+    main()
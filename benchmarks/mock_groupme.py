@@ -0,0 +1,259 @@
+# *------------------------------------------------------------------------------*
+# GroupMe Archiver: A web application to store and display GroupMe group histories
+# Copyright (C) 2016 Jordan Buchman
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# *------------------------------------------------------------------------------*
+
+# A local stand-in for the parts of the GroupMe v3 API the archiver pages
+# through, serving synthetic groups. It can inject 429 and 5xx responses to
+# exercise retries. benchmarks.generate writes the same synthetic messages
+# straight into a database.
+#
+#   python -m benchmarks.mock_groupme [--port 8089] [--groups 10]
+#       [--messages 10000] [--error-rate 0.05]
+#
+# then point the archiver at it by setting groupy.config.API_URL to
+# http://localhost:8089/v3.
+
+import argparse
+import asyncio
+import random
+import threading
+
+import groupy
+from aiohttp import web
+from groupy.api import endpoint
+
+FIRST_ID = 100000000000000000
+FIRST_CREATED_AT = 1451606400
+FIRST_USER_ID = 1000000
+
+# Message texts are drawn from these words, so searches for them match
+# predictable fractions of a group: the earlier a word is listed, the more
+# common it is.
+WORDS = ('the', 'and', 'lol', 'tonight', 'pizza', 'game', 'meeting', 'photo',
+         'birthday', 'homework', 'concert', 'airport', 'volcano', 'xylophone')
+
+
+class MockGroupMe:
+    """Groups are named "1" to ``groups``, each with ``messages`` messages
+    from ``members`` members, whose user ids start at FIRST_USER_ID so they
+    can't be mistaken for group ids. The i-th message of a conversation has id
+    base + i, where the base is unique to the conversation, and is the same
+    for a given ``seed``.
+
+    Messages get ``likes`` likes on average, and a fraction ``attachments``
+    of them has an attachment: mostly images, some mentions, locations and
+    emoji."""
+
+    def __init__(self, groups=10, messages=10000, members=50,
+                 error_rate=0.0, latency=0.0, likes=1.5, attachments=0.05,
+                 seed=0):
+        self.groups = groups
+        self.messages = messages
+        self.members = members
+        self.error_rate = error_rate
+        self.latency = latency
+        self.likes = likes
+        self.attachments = attachments
+        self.seed = seed
+        self.requests = 0
+
+    @staticmethod
+    def user_id(m):
+        return str(FIRST_USER_ID + m)
+
+    @staticmethod
+    def base(conversation_id, direct):
+        return FIRST_ID + (int(conversation_id) * 2 + direct) * 10 ** 8
+
+    def message(self, group_id, i, direct=False):
+        rng = random.Random(hash((self.seed, int(group_id), direct, i)))
+        user_id = self.user_id(rng.randrange(self.members))
+        likes = min(int(rng.expovariate(1 / self.likes) + 0.5) if self.likes else 0,
+                    self.members)
+        words = [WORDS[min(int(rng.expovariate(0.5)), len(WORDS) - 1)]
+                 for _ in range(rng.randint(1, 12))]
+        message = {
+            'id': str(self.base(group_id, direct) + i),
+            'source_guid': str(i),
+            'created_at': FIRST_CREATED_AT + i * 60,
+            'user_id': user_id,
+            'name': 'Member ' + user_id,
+            'avatar_url': None,
+            'text': 'Message {0}: {1}'.format(i, ' '.join(words)),
+            'system': False,
+            'favorited_by': [self.user_id(m)
+                             for m in rng.sample(range(self.members), likes)],
+            'attachments': (self.attachment(rng, i)
+                            if rng.random() < self.attachments else [])}
+        if direct:
+            message['recipient_id'] = group_id
+        else:
+            message['group_id'] = group_id
+        return message
+
+    def attachment(self, rng, i):
+        kind = rng.random()
+        if kind < 0.7:
+            return [{'type': 'image',
+                     'url': 'https://i.groupme.com/{0}.png'.format(i % 1000)}]
+        if kind < 0.85:
+            user_id = self.user_id(rng.randrange(self.members))
+            return [{'type': 'mentions', 'user_ids': [user_id],
+                     'loci': [[0, 7]]}]
+        if kind < 0.95:
+            return [{'type': 'location', 'name': 'Somewhere',
+                     'lat': str(rng.uniform(-90, 90)),
+                     'lng': str(rng.uniform(-180, 180))}]
+        return [{'type': 'emoji', 'placeholder': '\ufffd',
+                 'charmap': [[1, rng.randrange(50)]]}]
+
+    def window(self, request, base):
+        """Indexes of the messages to return, in response order."""
+
+        limit = min(int(request.query.get('limit', 20)), 100)
+        if 'after_id' in request.query:
+            start = int(request.query['after_id']) - base + 1
+            return range(start, min(start + limit, self.messages))
+        end = self.messages
+        if 'before_id' in request.query:
+            end = int(request.query['before_id']) - base
+        return range(end - 1, max(end - limit, 0) - 1, -1)
+
+    async def maybe_fail(self):
+        """Return an injected error response, or None."""
+
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if random.random() < self.error_rate:
+            status = random.choice((429, 500, 502, 503))
+            return web.Response(
+                status=status,
+                headers={'Retry-After': '1'} if status == 429 else None)
+        return None
+
+    def respond(self, key, messages):
+        if not messages:
+            return web.Response(status=304)
+        return web.json_response({
+            'response': {'count': self.messages, key: messages},
+            'meta': {'code': 200}})
+
+    async def group_messages(self, request):
+        failure = await self.maybe_fail()
+        if failure:
+            return failure
+        group_id = request.match_info['group_id']
+        if not 1 <= int(group_id) <= self.groups:
+            return web.Response(status=404)
+        return self.respond('messages', [self.message(group_id, i)
+                                         for i in self.window(request, self.base(group_id, False))])
+
+    async def direct_messages(self, request):
+        failure = await self.maybe_fail()
+        if failure:
+            return failure
+        user_id = request.query['other_user_id']
+        return self.respond('direct_messages',
+                            [self.message(user_id, i, direct=True)
+                             for i in self.window(request, self.base(user_id, True))])
+
+    async def groups_index(self, request):
+        failure = await self.maybe_fail()
+        if failure:
+            return failure
+        page = int(request.query.get('page', 1))
+        groups = [] if page > 1 else [{
+            'id': str(i),
+            'group_id': str(i),
+            'name': 'Group {0}'.format(i),
+            'type': 'private',
+            'description': '',
+            'image_url': None,
+            'creator_user_id': self.user_id(0),
+            'created_at': FIRST_CREATED_AT,
+            'updated_at': FIRST_CREATED_AT,
+            'messages': {'count': self.messages,
+                         'last_message_id': str(self.base(i, False) + self.messages - 1),
+                         'last_message_created_at': FIRST_CREATED_AT + (self.messages - 1) * 60},
+            'members': [{'id': str(m), 'user_id': self.user_id(m),
+                         'nickname': 'Member ' + self.user_id(m),
+                         'image_url': None, 'muted': False,
+                         'autokicked': False}
+                        for m in range(self.members)]}
+            for i in range(1, self.groups + 1)]
+        return web.json_response({'response': groups, 'meta': {'code': 200}})
+
+    async def me(self, request):
+        return web.json_response({'response': {
+            'id': self.user_id(0), 'user_id': self.user_id(0),
+            'name': 'Member ' + self.user_id(0), 'image_url': None,
+            'created_at': FIRST_CREATED_AT, 'updated_at': FIRST_CREATED_AT},
+            'meta': {'code': 200}})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/v3/groups', self.groups_index)
+        app.router.add_get('/v3/groups/{group_id}/messages', self.group_messages)
+        app.router.add_get('/v3/direct_messages', self.direct_messages)
+        app.router.add_get('/v3/users/me', self.me)
+        return app
+
+
+def serve(mock, port):
+    """Serve ``mock`` on a background thread and return its API URL."""
+
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(mock.app())
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, 'localhost', port).start())
+    thread = threading.Thread(target=loop.run_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://localhost:{0}/v3'.format(port)
+
+
+def use_mock(url):
+    """Point groupy, and so everything the archiver fetches, at ``url``
+    instead of the real API. Has to be called before app is imported."""
+
+    for value in vars(endpoint).values():
+        if isinstance(value, type) and isinstance(getattr(value, 'url', None), str):
+            value.url = value.url.replace(groupy.config.API_URL, url)
+    groupy.config.API_URL = url
+    if not groupy.config.API_KEY:
+        groupy.config.API_KEY = 'benchmark'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--groups', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--members', type=int, default=50)
+    parser.add_argument('--likes', type=float, default=1.5)
+    parser.add_argument('--attachments', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args()
+    mock = MockGroupMe(args.groups, args.messages, args.members,
+                       args.error_rate, args.latency, args.likes,
+                       args.attachments, args.seed)
+    web.run_app(mock.app(), port=args.port)
+
+if __name__ == "__main__":
+    main()
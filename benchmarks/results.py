@@ -0,0 +1,96 @@
+# *------------------------------------------------------------------------------*
+# GroupMe Archiver: A web application to store and display GroupMe group histories
+# Copyright (C) 2016 Jordan Buchman
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# *------------------------------------------------------------------------------*
+
+# Machine-readable benchmark results. The benchmarks write theirs as JSON
+# with -o FILE, and two such files, e.g. from before and after a change, are
+# compared with
+#
+#   python -m benchmarks.results OLD.json NEW.json
+
+import argparse
+import json
+import platform
+import subprocess
+from datetime import datetime, timezone
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write(path, benchmark, params, results, conn=None):
+    """Write the ``results`` of a run, a dict of named dicts of numbers,
+    together with its ``params`` and where it ran."""
+
+    environment = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'host': platform.node()}
+    if conn is not None:
+        environment['postgres'] = conn.server_version
+    with open(path, 'w') as f:
+        json.dump({'benchmark': benchmark,
+                   'created_at': datetime.now(timezone.utc).isoformat(),
+                   'environment': environment,
+                   'params': params,
+                   'results': results}, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def compare(old, new):
+    """Print every number that both runs measured, side by side."""
+
+    if old['benchmark'] != new['benchmark']:
+        print("Comparing {0} results to {1} results".format(
+            old['benchmark'], new['benchmark']))
+    for key in sorted(set(old['params']) | set(new['params'])):
+        if old['params'].get(key) != new['params'].get(key):
+            print("params differ: {0} = {1!r} / {2!r}".format(
+                key, old['params'].get(key), new['params'].get(key)))
+    print("{0:<40} {1:>14} {2:>14} {3:>8}".format(
+        '', old['environment'].get('commit') or 'old',
+        new['environment'].get('commit') or 'new', 'change'))
+    for name in sorted(set(old['results']) & set(new['results'])):
+        for metric in sorted(set(old['results'][name]) & set(new['results'][name])):
+            before = old['results'][name][metric]
+            after = new['results'][name][metric]
+            if not isinstance(before, (int, float)) or not isinstance(after, (int, float)):
+                continue
+            change = ('{0:+.1f}%'.format((after - before) / before * 100)
+                      if before else '')
+            print("{0:<40} {1:>14.4g} {2:>14.4g} {3:>8}".format(
+                name + ' ' + metric, before, after, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark runs.")
+    parser.add_argument('old')
+    parser.add_argument('new')
+    args = parser.parse_args()
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    compare(old, new)
+
+if __name__ == "__main__":
+    main()
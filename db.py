@@ -0,0 +1,254 @@
+# *------------------------------------------------------------------------------*
+# GroupMe Archiver: A web application to store and display GroupMe group histories
+# Copyright (C) 2016 Jordan Buchman
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# *------------------------------------------------------------------------------*
+
+# Pool of database connections shared by the web requests and sync jobs.
+
+import select
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
+
+
+class TimedCursor:
+    """Mixed into a connection's cursor classes by TimedConnection."""
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self.connection.timed(query, time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self.connection.timed(query, time.perf_counter() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            self.connection.timed(sql, time.perf_counter() - start)
+
+
+timed_cursor_classes = {}
+
+
+class TimedConnection(psycopg2.extensions.connection):
+    """Connection that passes every query run on its cursors and how long it
+    took to ``on_query(query, seconds)``, if set."""
+
+    on_query = None
+
+    def cursor(self, *args, **kwargs):
+        factory = (kwargs.get('cursor_factory') or self.cursor_factory or
+                   psycopg2.extensions.cursor)
+        timed = timed_cursor_classes.get(factory)
+        if timed is None:
+            timed = timed_cursor_classes[factory] = type(
+                'Timed' + factory.__name__, (TimedCursor, factory), {})
+        kwargs['cursor_factory'] = timed
+        return super().cursor(*args, **kwargs)
+
+    def timed(self, query, seconds):
+        if self.on_query is not None:
+            self.on_query(query, seconds)
+
+
+class ConnectionPool:
+    """Thread-safe pool of at most ``size`` connections. Unlike
+    ThreadedConnectionPool, callers wait for a free connection instead of
+    getting an error when the pool is exhausted. Connections that have been
+    idle for ``health_check_interval`` seconds are checked with a trivial
+    query before being handed out, and broken ones are replaced. With
+    ``on_query``, every query run on a pooled connection is reported to
+    ``on_query(query, seconds)``.
+
+    Nothing connects before the first ``getconn()`` (unless ``minconn`` is
+    set), and ``prepare(conn)``, if given, is called with that first
+    connection before any is handed out, e.g. to migrate the schema."""
+
+    def __init__(self, minconn, size, health_check_interval=30, on_query=None,
+                 prepare=None, **conn_args):
+        if on_query is not None:
+            conn_args['connection_factory'] = TimedConnection
+        self.on_query = on_query
+        self.prepare = prepare
+        self.prepare_lock = threading.Lock()
+        self.pool = ThreadedConnectionPool(minconn, size, **conn_args)
+        self.slots = threading.BoundedSemaphore(size)
+        self.health_check_interval = health_check_interval
+        self.lock = threading.Lock()
+        self.last_used = {}
+        self.stats = {
+            'size': size,
+            'in_use': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'wait_seconds': 0.0,
+            'max_wait_seconds': 0.0,
+            'replaced': 0}
+
+    def getconn(self):
+        if not self.slots.acquire(blocking=False):
+            start = time.time()
+            self.slots.acquire()
+            waited = time.time() - start
+            with self.lock:
+                self.stats['waits'] += 1
+                self.stats['wait_seconds'] += waited
+                self.stats['max_wait_seconds'] = max(
+                    self.stats['max_wait_seconds'], waited)
+        try:
+            conn = self.checkout()
+        except:
+            self.slots.release()
+            raise
+        if self.prepare is not None:
+            try:
+                with self.prepare_lock:
+                    if self.prepare is not None:
+                        self.prepare(conn)
+                        self.prepare = None
+            except:
+                self.pool.putconn(conn)
+                self.slots.release()
+                raise
+        with self.lock:
+            self.stats['in_use'] += 1
+            self.stats['checkouts'] += 1
+        return conn
+
+    def checkout(self):
+        while True:
+            conn = self.pool.getconn()
+            if self.healthy(conn):
+                if isinstance(conn, TimedConnection):
+                    conn.on_query = self.on_query
+                return conn
+            self.last_used.pop(id(conn), None)
+            self.pool.putconn(conn, close=True)
+            with self.lock:
+                self.stats['replaced'] += 1
+
+    def healthy(self, conn):
+        if conn.closed:
+            return False
+        idle = time.time() - self.last_used.get(id(conn), time.time())
+        if idle < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def putconn(self, conn):
+        # End whatever transaction the borrower left open.
+        try:
+            if not conn.closed:
+                conn.rollback()
+        except psycopg2.Error:
+            pass
+        self.last_used[id(conn)] = time.time()
+        self.pool.putconn(conn, close=bool(conn.closed))
+        with self.lock:
+            self.stats['in_use'] -= 1
+        self.slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+class Listener:
+    """Calls ``handle(payload)`` on a background thread for every
+    notification sent to ``channel`` with NOTIFY or pg_notify(), using a
+    connection of its own. Notifications sent while the connection is down
+    are lost, so ``reset()`` is called whenever listening starts, including
+    after reconnecting. An idle connection is checked every ``keepalive``
+    seconds."""
+
+    def __init__(self, channel, handle, reset=None, retry_delay=5, keepalive=60,
+                 **conn_args):
+        self.channel = channel
+        self.handle = handle
+        self.reset = reset
+        self.retry_delay = retry_delay
+        self.keepalive = keepalive
+        self.conn_args = conn_args
+        self.conn = None
+        self.lock = threading.Lock()
+        self.started = False
+
+    def start(self):
+        """Start listening. The first connection is made by the caller, so
+        nothing that happens after this returns is missed."""
+
+        with self.lock:
+            if self.started:
+                return
+            self.listen()
+            self.started = True
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def listen(self):
+        conn = psycopg2.connect(**self.conn_args)
+        conn.autocommit = True
+        conn.cursor().execute('LISTEN "{0}";'.format(self.channel))
+        self.conn = conn
+        if self.reset:
+            self.reset()
+
+    def run(self):
+        while True:
+            try:
+                if self.conn is None:
+                    self.listen()
+                if not select.select([self.conn], [], [], self.keepalive)[0]:
+                    self.conn.cursor().execute("SELECT 1;")
+                self.conn.poll()
+                while self.conn.notifies:
+                    self.handle(self.conn.notifies.pop(0).payload)
+            except Exception:
+                traceback.print_exc()
+                if self.conn is not None:
+                    self.conn.close()
+                    self.conn = None
+                if self.reset:
+                    self.reset()
+                time.sleep(self.retry_delay)
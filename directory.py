@@ -0,0 +1,189 @@
+# *------------------------------------------------------------------------------*
+# GroupMe Archiver: A web application to store and display GroupMe group histories
+# Copyright (C) 2016 Jordan Buchman
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# *------------------------------------------------------------------------------*
+
+# Cached listing of the groups the API key belongs to and the people it can
+# message directly, shared by the web pages and the sync job.
+
+import threading
+import time
+import traceback
+from collections import Counter, OrderedDict
+
+
+class Directory:
+    """Groups and DM partners of the API key, refreshed on a background
+    thread every ``ttl`` seconds.
+
+    ``load()`` returns the current groups as dicts with an ``id``, ``name``,
+    ``image_url``, ``description``, ``message_count`` and ``members``, a list
+    of (user_id, nickname, image_url). DM partners are everyone who shares a
+    group with us, under their most common nickname. After every refresh
+    ``store(groups, members)`` is called to persist the listing, which
+    ``restore()`` returns as (groups, members) when the directory is first
+    used. Nothing is loaded, and no thread started, before then.
+
+    Readers never wait for the API unless they ask to: stale entries are
+    served while a refresh is running. A failed refresh is retried after
+    ``min_refresh`` seconds, which is also the least time between two
+    refreshes forced by lookups of unknown ids."""
+
+    def __init__(self, load, store=None, restore=None, ttl=300, min_refresh=30):
+        self.load = load
+        self.store = store
+        self.restore = restore
+        self.ttl = ttl
+        self.min_refresh = min_refresh
+        self.groups = OrderedDict()
+        self.members = OrderedDict()
+        self.refreshed = None
+        self.next_refresh = 0
+        self.requested = False
+        self.generation = 0
+        self.refreshing = False
+        self.cond = threading.Condition()
+        self.started = False
+        self.stats = {'refreshes': 0, 'failures': 0, 'seconds': 0.0}
+
+    def seed(self, groups, members):
+        """Serve previously stored entries until the first refresh."""
+
+        with self.cond:
+            if self.refreshed is None:
+                self.groups = OrderedDict((group['id'], group) for group in groups)
+                self.members = OrderedDict((member['user_id'], member)
+                                           for member in members)
+
+    def listing(self, wait=False):
+        """Return the groups and DM partners. With ``wait``, a listing older
+        than ``ttl`` is refreshed first."""
+
+        self.start()
+        if wait and self.stale():
+            self.refresh(wait=True)
+        with self.cond:
+            return list(self.groups.values()), list(self.members.values())
+
+    def group(self, group_id, wait=False):
+        return self.lookup('groups', group_id, wait)
+
+    def member(self, user_id, wait=False):
+        return self.lookup('members', user_id, wait)
+
+    def lookup(self, kind, id, wait):
+        """Return a cached entry, or None. With ``wait``, an id that isn't
+        cached (e.g. a group created since the last refresh) is looked up
+        again by a refresh, unless one finished less than ``min_refresh``
+        seconds ago."""
+
+        self.start()
+        # Look the entries up again after the refresh, which replaces them.
+        with self.cond:
+            entry = getattr(self, kind).get(id)
+            recent = (self.refreshed is not None and
+                      time.time() - self.refreshed < self.min_refresh)
+        if entry is not None or not wait or recent:
+            return entry
+        self.refresh(wait=True)
+        with self.cond:
+            return getattr(self, kind).get(id)
+
+    def stale(self):
+        with self.cond:
+            return (self.refreshed is None or
+                    time.time() - self.refreshed >= self.ttl)
+
+    def refresh(self, wait=False):
+        """Refresh as soon as possible. With ``wait``, block until a refresh
+        that started after this call has finished."""
+
+        self.start()
+        with self.cond:
+            # A refresh that's already running may have missed the change
+            # the caller is looking for.
+            target = self.generation + (2 if self.refreshing else 1)
+            self.requested = True
+            self.cond.notify_all()
+            while wait and self.generation < target:
+                self.cond.wait()
+
+    def start(self):
+        with self.cond:
+            if self.started:
+                return
+            if self.restore:
+                self.seed(*self.restore())
+            self.started = True
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.requested and time.time() < self.next_refresh:
+                    self.cond.wait(self.next_refresh - time.time())
+                self.requested = False
+                self.refreshing = True
+            start = time.time()
+            try:
+                groups = self.load()
+                members = partners(groups)
+                if self.store:
+                    self.store(groups, members)
+                ok = True
+            except Exception:
+                traceback.print_exc()
+                ok = False
+            with self.cond:
+                self.stats['seconds'] += time.time() - start
+                if ok:
+                    self.groups = OrderedDict((group['id'], group) for group in groups)
+                    self.members = OrderedDict((member['user_id'], member)
+                                               for member in members)
+                    self.refreshed = time.time()
+                    self.stats['refreshes'] += 1
+                    self.next_refresh = self.refreshed + self.ttl
+                else:
+                    self.stats['failures'] += 1
+                    self.next_refresh = time.time() + self.min_refresh
+                self.refreshing = False
+                self.generation += 1
+                self.cond.notify_all()
+
+    def get_stats(self):
+        with self.cond:
+            stats = dict(self.stats)
+            stats['groups'] = len(self.groups)
+            stats['members'] = len(self.members)
+            stats['age'] = (time.time() - self.refreshed
+                            if self.refreshed is not None else None)
+            return stats
+
+
+def partners(groups):
+    """Everyone in ``groups``, once, under their most common nickname."""
+
+    nicknames = OrderedDict()
+    images = {}
+    for group in groups:
+        for user_id, nickname, image_url in group['members']:
+            nicknames.setdefault(user_id, Counter())[nickname] += 1
+            images.setdefault(user_id, image_url)
+    return [{'user_id': user_id,
+             'nickname': counts.most_common(1)[0][0],
+             'image_url': images[user_id]}
+            for user_id, counts in nicknames.items()]
@@ -0,0 +1,225 @@
+# *------------------------------------------------------------------------------*
+# GroupMe Archiver: A web application to store and display GroupMe group histories
+# Copyright (C) 2016 Jordan Buchman
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# *------------------------------------------------------------------------------*
+
+# Message page fetching for the sync job. All requests go through one asyncio
+# event loop running on a background thread, so pages for many groups are
+# fetched concurrently over shared keep-alive connections and under a single
+# global rate limit, while sync workers consume them as plain iterators.
+
+import asyncio
+import random
+import threading
+import time
+
+import aiohttp
+
+
+class FetchError(Exception):
+    """A page could not be fetched, even after retrying."""
+    pass
+
+
+class RetryableStatus(Exception):
+    def __init__(self, status, retry_after=None):
+        super().__init__(status)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Allows ``rate`` requests per second on average and bursts of up to
+    ``burst`` requests. Only used from the fetcher's event loop."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for ``seconds`` (e.g. after a 429)."""
+
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class Fetcher:
+    """Fetches pages of group messages and direct messages from the GroupMe
+    API.
+
+    Requests are limited to ``rate`` per second (bursts of ``burst``) across
+    all groups and use at most ``connections`` pooled HTTP connections. 429
+    and 5xx responses and connection errors are retried up to ``retries``
+    times with exponential backoff (honouring Retry-After), after which
+    FetchError is raised."""
+
+    def __init__(self, token, api_url, rate=5, burst=10, connections=8,
+                 retries=5, backoff=1, max_backoff=60, timeout=30):
+        self.token = token
+        self.api_url = api_url.rstrip('/')
+        self.bucket = TokenBucket(rate, burst)
+        self.connections = connections
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.session = None
+        self.stats = {'requests': 0, 'retries': 0, 'failures': 0,
+                      'pages': 0, 'messages': 0, 'seconds': 0.0}
+        self.loop = asyncio.new_event_loop()
+        self.lock = threading.Lock()
+        self.started = False
+
+    def run(self, coro):
+        """Run a coroutine on the fetcher's loop, which is started on first
+        use, and wait for its result."""
+
+        with self.lock:
+            if not self.started:
+                thread = threading.Thread(target=self.loop.run_forever)
+                thread.daemon = True
+                thread.start()
+                self.started = True
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def get(self, path, params, stats=None):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        params = dict((key, value) for key, value in params.items()
+                      if value is not None)
+        params['token'] = self.token
+        for attempt in range(self.retries + 1):
+            await self.bucket.acquire()
+            start = time.monotonic()
+            self.stats['requests'] += 1
+            try:
+                async with self.session.get(self.api_url + path, params=params) as r:
+                    if r.status == 304:
+                        return None
+                    if r.status == 429 or r.status >= 500:
+                        raise RetryableStatus(
+                            r.status, r.headers.get('Retry-After'))
+                    if r.status >= 400:
+                        self.stats['failures'] += 1
+                        raise FetchError(
+                            "{0} returned {1}".format(path, r.status))
+                    data = await r.json(content_type=None)
+                    return data['response']
+            except (RetryableStatus, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    self.stats['failures'] += 1
+                    raise FetchError("{0} failed: {1!r}".format(path, e))
+                self.stats['retries'] += 1
+                delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+                delay *= random.uniform(0.5, 1)
+                retry_after = getattr(e, 'retry_after', None)
+                if retry_after and retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+                if getattr(e, 'status', None) == 429:
+                    # Everyone is over the limit, not just this request.
+                    self.bucket.pause(delay)
+            finally:
+                elapsed = time.monotonic() - start
+                self.stats['seconds'] += elapsed
+                if stats is not None:
+                    stats['requests'] += 1
+                    stats['seconds'] += elapsed
+            await asyncio.sleep(delay)
+
+    async def page(self, type, id, before_id=None, after_id=None, stats=None):
+        """Fetch one page of messages. Pages fetched with ``before_id`` are
+        newest first, pages fetched with ``after_id`` oldest first. Returns []
+        when there are no more messages."""
+
+        if type == "group":
+            response = await self.get(
+                '/groups/{0}/messages'.format(id),
+                {'before_id': before_id, 'after_id': after_id, 'limit': 100},
+                stats)
+            messages = response['messages'] if response else []
+        else:
+            response = await self.get(
+                '/direct_messages',
+                {'other_user_id': id, 'before_id': before_id, 'after_id': after_id},
+                stats)
+            messages = response['direct_messages'] if response else []
+        self.stats['pages'] += 1
+        self.stats['messages'] += len(messages)
+        if stats is not None:
+            stats['pages'] += 1
+            stats['messages'] += len(messages)
+        return messages
+
+    async def produce(self, pages, type, id, before_id, after_id, stats):
+        try:
+            while True:
+                messages = await self.page(type, id, before_id, after_id, stats)
+                if not messages:
+                    break
+                await pages.put(messages)
+                # Both directions continue from the last message of the page.
+                if after_id is not None:
+                    after_id = messages[-1]['id']
+                else:
+                    before_id = messages[-1]['id']
+            await pages.put(None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await pages.put(e)
+
+    def pages(self, type, id, before_id=None, after_id=None, prefetch=2,
+              stats=None):
+        """Iterate over pages of raw messages, walking older from
+        ``before_id`` (or from the newest message) or newer from ``after_id``.
+        Up to ``prefetch`` pages are fetched ahead while the caller is busy
+        with the current one. The requests, pages and messages fetched and
+        the seconds spent waiting for responses are added to the ``stats``
+        dict, if given."""
+
+        async def start():
+            pages = asyncio.Queue(prefetch)
+            task = self.loop.create_task(
+                self.produce(pages, type, id, before_id, after_id, stats))
+            return pages, task
+
+        pages, task = self.run(start())
+        try:
+            while True:
+                messages = self.run(pages.get())
+                if messages is None:
+                    return
+                if isinstance(messages, Exception):
+                    raise messages
+                yield messages
+        finally:
+            self.loop.call_soon_threadsafe(task.cancel)
+
+    def get_stats(self):
+        return dict(self.stats)
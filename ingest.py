@@ -0,0 +1,149 @@
+# *------------------------------------------------------------------------------*
+# GroupMe Archiver: A web application to store and display GroupMe group histories
+# Copyright (C) 2016 Jordan Buchman
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# *------------------------------------------------------------------------------*
+
+# Bulk loading of message and member rows. Rows are COPYed into a temporary
+# staging table and merged into the real table with one upsert per batch,
+# instead of one INSERT round-trip per row.
+
+import io
+import json
+from datetime import datetime
+
+
+def copy_escape(value):
+    """Format a value as a field of PostgreSQL's COPY text format"""
+
+    if value is None:
+        return '\\N'
+    if isinstance(value, (list, tuple)):
+        value = array_literal(value)
+    elif isinstance(value, datetime):
+        value = value.isoformat()
+    elif isinstance(value, bool):
+        value = 't' if value else 'f'
+    else:
+        value = str(value)
+    return (value.replace('\\', '\\\\')
+                 .replace('\t', '\\t')
+                 .replace('\n', '\\n')
+                 .replace('\r', '\\r'))
+
+
+def array_literal(values):
+    items = []
+    for value in values:
+        if value is None:
+            items.append('NULL')
+        else:
+            items.append('"' + str(value).replace('\\', '\\\\')
+                                         .replace('"', '\\"') + '"')
+    return '{' + ','.join(items) + '}'
+
+
+def copy_rows(cur, table, rows):
+    if not rows:
+        return
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(copy_escape(value) for value in row))
+        buf.write('\n')
+    buf.seek(0)
+    cur.copy_expert("COPY {0} FROM STDIN".format(table), buf)
+
+
+def number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def attachment_row(message_id, position, attachment):
+    """Format an attachment, as returned by the API, as a message_attachments
+    row. The whole attachment is kept in ``data``."""
+
+    return (message_id,
+            position,
+            attachment.get('type') or 'unknown',
+            attachment.get('url'),
+            attachment.get('name'),
+            number(attachment.get('lat')),
+            number(attachment.get('lng')),
+            attachment.get('user_ids'),
+            json.dumps(attachment))
+
+
+def bulk_insert_messages(cur, rows, likes=(), attachments=()):
+    """Insert message rows (in messages column order), skipping ids that are
+    already archived, together with their (message_id, user_id) likes and
+    message_attachments rows. Returns the (id, user_id, group_id, created_at)
+    of the messages that were actually inserted."""
+
+    if not rows:
+        return []
+    cur.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS messages_staging (LIKE messages) ON COMMIT DELETE ROWS;")
+    copy_rows(cur, "messages_staging", rows)
+    cur.execute(
+        "INSERT INTO messages SELECT * FROM messages_staging ON CONFLICT DO NOTHING RETURNING id, user_id, group_id, created_at;")
+    inserted = cur.fetchall()
+    cur.execute("TRUNCATE messages_staging;")
+    # Likes and attachments of new messages can't conflict with anything, so
+    # they are copied straight into their tables.
+    new_ids = set(row['id'] if isinstance(row, dict) else row[0]
+                  for row in inserted)
+    copy_rows(cur, "message_likes",
+              [like for like in likes if like[0] in new_ids])
+    copy_rows(cur, "message_attachments",
+              [row for row in attachments if row[0] in new_ids])
+    return inserted
+
+
+def bulk_upsert_members(cur, rows):
+    """Insert or update member rows (user_id, nickname, avatar, group_id).
+    Returns the (user_id, group_id) of the members that were added or
+    changed."""
+
+    if not rows:
+        return []
+    cur.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS members_staging (LIKE members) ON COMMIT DELETE ROWS;")
+    copy_rows(cur, "members_staging", rows)
+    cur.execute(
+        "INSERT INTO members SELECT DISTINCT ON (user_id, group_id) * FROM members_staging ON CONFLICT (user_id, group_id) DO UPDATE SET nickname = EXCLUDED.nickname, avatar = EXCLUDED.avatar WHERE (members.nickname, members.avatar) IS DISTINCT FROM (EXCLUDED.nickname, EXCLUDED.avatar) RETURNING user_id, group_id;")
+    changed = cur.fetchall()
+    cur.execute("TRUNCATE members_staging;")
+    return changed
+
+
+def bulk_upsert_groups(cur, rows):
+    """Insert or update directory rows of the groups table (name, image_url,
+    description, id, type, archived, message_count). The archived flag of
+    existing rows is left alone, and so is the profile of archived DM
+    conversations, which the sync job keeps up to date. Returns the ids of
+    the rows that were added or changed."""
+
+    if not rows:
+        return []
+    cur.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS groups_staging (LIKE groups) ON COMMIT DELETE ROWS;")
+    copy_rows(cur, "groups_staging", rows)
+    cur.execute(
+        "INSERT INTO groups SELECT DISTINCT ON (id) * FROM groups_staging ON CONFLICT (id) DO UPDATE SET name = EXCLUDED.name, image_url = EXCLUDED.image_url, description = EXCLUDED.description, message_count = EXCLUDED.message_count WHERE (groups.type = 'group' OR NOT groups.archived) AND (groups.name, groups.image_url, groups.description, groups.message_count) IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.image_url, EXCLUDED.description, EXCLUDED.message_count) RETURNING id;")
+    changed = cur.fetchall()
+    cur.execute("TRUNCATE groups_staging;")
+    return changed
@@ -0,0 +1,213 @@
+# *------------------------------------------------------------------------------*
+# GroupMe Archiver: A web application to store and display GroupMe group histories
+# Copyright (C) 2016 Jordan Buchman
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# *------------------------------------------------------------------------------*
+
+# Sharing the archived groups between sync processes, which may run on
+# different hosts, through lease rows in the database.
+
+import math
+import os
+import random
+import socket
+import threading
+import traceback
+import uuid
+
+import psycopg2
+
+
+class LeaseLost(Exception):
+    """Another worker has taken over the group being synced."""
+    pass
+
+
+class Leases:
+    """Claims this worker's share of the archived groups and adds them to
+    ``scheduler``, every ``heartbeat`` seconds.
+
+    Each worker registers itself in sync_workers and holds a lease in
+    sync_leases for every group it syncs. Leases are renewed for ``ttl``
+    seconds on every heartbeat, so the groups of a worker that died are
+    claimed by the others once its leases run out. A worker claims up to its
+    share (the archived groups divided by the live workers), and gives up
+    idle groups beyond its share so that new workers get some. Claims are
+    decided by the database, so no group is leased to two workers at once.
+
+    A group claimed for the first time is synced right away, others at a
+    random point within ``spread`` seconds. Syncs call ``holds()`` before
+    committing, which fails if the lease ran out in the meantime.
+
+    Heartbeats use a connection of their own, so renewals never wait for a
+    pooled connection busy with requests or syncs."""
+
+    def __init__(self, scheduler, ttl=60, heartbeat=15, spread=60, **conn_args):
+        self.scheduler = scheduler
+        self.conn_args = conn_args
+        self.conn = None
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.spread = spread
+        self.owner = '{0}:{1}:{2}'.format(socket.gethostname(), os.getpid(),
+                                          uuid.uuid4().hex[:8])
+        self.held = set()
+        self.cond = threading.Condition()
+        self.requested = False
+        self.started = False
+        self.stats = {'workers': 0, 'share': 0, 'claimed': 0, 'released': 0,
+                      'lost': 0, 'heartbeats': 0, 'failures': 0}
+
+    def start(self):
+        with self.cond:
+            if self.started:
+                return
+            self.started = True
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def wake(self):
+        """Claim groups now instead of at the next heartbeat, e.g. because
+        a group was archived."""
+
+        with self.cond:
+            self.requested = True
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            try:
+                self.beat()
+            except Exception:
+                traceback.print_exc()
+                if self.conn is not None:
+                    self.conn.close()
+                    self.conn = None
+                with self.cond:
+                    self.stats['failures'] += 1
+            with self.cond:
+                if not self.requested:
+                    self.cond.wait(self.heartbeat)
+                self.requested = False
+
+    def beat(self):
+        if self.conn is None:
+            self.conn = psycopg2.connect(**self.conn_args)
+        conn = self.conn
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO sync_workers VALUES (%s, now() + %s * interval '1 second') ON CONFLICT (id) DO UPDATE SET expires_at = EXCLUDED.expires_at;",
+            (self.owner, self.ttl))
+        cur.execute("DELETE FROM sync_workers WHERE expires_at <= now();")
+        cur.execute("SELECT count(*) FROM sync_workers;")
+        workers = cur.fetchone()[0]
+        cur.execute(
+            "UPDATE sync_leases SET expires_at = now() + %s * interval '1 second' WHERE owner = %s AND expires_at > now() RETURNING group_id;",
+            (self.ttl, self.owner))
+        renewed = set(row[0] for row in cur.fetchall())
+        conn.commit()
+
+        # Leases that ran out may already belong to someone else.
+        lost = self.held - renewed
+        for group_id in lost:
+            self.scheduler.remove(group_id)
+        self.held = renewed
+
+        cur.execute("SELECT count(*) FROM groups WHERE archived;")
+        share = math.ceil(cur.fetchone()[0] / workers)
+        released = []
+        for group_id in random.sample(sorted(self.held),
+                                      max(len(self.held) - share, 0)):
+            if self.scheduler.remove(group_id, only_idle=True):
+                released.append(group_id)
+        if released:
+            cur.execute(
+                "UPDATE sync_leases SET owner = NULL, expires_at = now() WHERE owner = %s AND group_id = ANY(%s);",
+                (self.owner, released))
+            conn.commit()
+            self.held -= set(released)
+
+        claimed = []
+        if len(self.held) < share:
+            # A worker claiming a group another one is claiming waits for
+            # it and then finds the lease taken. Claiming in id order keeps
+            # two claims from waiting for each other.
+            cur.execute("""
+              WITH claimed AS (
+                INSERT INTO sync_leases
+                SELECT id, %(owner)s, now() + %(ttl)s * interval '1 second'
+                FROM groups
+                WHERE archived AND NOT EXISTS (
+                  SELECT 1 FROM sync_leases
+                  WHERE group_id = groups.id AND expires_at > now())
+                ORDER BY id
+                LIMIT %(limit)s
+                ON CONFLICT (group_id) DO UPDATE
+                SET owner = EXCLUDED.owner, expires_at = EXCLUDED.expires_at
+                WHERE sync_leases.expires_at <= now()
+                RETURNING group_id)
+              SELECT claimed.group_id, groups.type, sync_state.group_id IS NULL
+              FROM claimed
+              JOIN groups ON groups.id = claimed.group_id
+              LEFT JOIN sync_state ON sync_state.group_id = claimed.group_id
+            """, {'owner': self.owner, 'ttl': self.ttl,
+                  'limit': share - len(self.held)})
+            claimed = cur.fetchall()
+        conn.commit()
+        for group_id, type, new in claimed:
+            self.held.add(group_id)
+            self.scheduler.add(group_id, type,
+                               delay=0 if new else random.uniform(0, self.spread))
+
+        with self.cond:
+            self.stats['workers'] = workers
+            self.stats['share'] = share
+            self.stats['claimed'] += len(claimed)
+            self.stats['released'] += len(released)
+            self.stats['lost'] += len(lost)
+            self.stats['heartbeats'] += 1
+
+    def holds(self, cur, group_id):
+        """Whether this worker holds the group's lease. The lease can't
+        change hands until the caller's transaction ends."""
+
+        cur.execute(
+            "SELECT 1 FROM sync_leases WHERE group_id = %s AND owner = %s AND expires_at > now() FOR SHARE;",
+            (group_id, self.owner))
+        return cur.fetchone() is not None
+
+    def release_all(self):
+        """Give up every lease, so other workers take over right away, e.g.
+        when shutting down."""
+
+        # The heartbeat may be using its connection.
+        conn = psycopg2.connect(**self.conn_args)
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                "UPDATE sync_leases SET owner = NULL, expires_at = now() WHERE owner = %s;",
+                (self.owner,))
+            cur.execute("DELETE FROM sync_workers WHERE id = %s;", (self.owner,))
+            conn.commit()
+        finally:
+            conn.close()
+        self.held = set()
+
+    def get_stats(self):
+        with self.cond:
+            stats = dict(self.stats)
+            stats['owner'] = self.owner
+            stats['held'] = len(self.held)
+            return stats
@@ -0,0 +1,211 @@
+# *------------------------------------------------------------------------------*
+# GroupMe Archiver: A web application to store and display GroupMe group histories
+# Copyright (C) 2016 Jordan Buchman
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# *------------------------------------------------------------------------------*
+
+# Local copies of the images and avatars archived messages link to, so that
+# pages don't depend on GroupMe's CDN or break when its URLs expire.
+
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import traceback
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from PIL import Image
+
+
+def download(url, max_bytes, timeout=30):
+    """Fetch a URL. Returns its content and content type."""
+
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        data = response.read(max_bytes + 1)
+        if len(data) > max_bytes:
+            raise ValueError("{0} is larger than {1} bytes".format(url, max_bytes))
+        return data, response.headers.get_content_type()
+
+
+def thumbnail(data, size):
+    """Return a JPEG of an image scaled to fit ``size`` x ``size`` pixels,
+    or None if Pillow can't read it."""
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.thumbnail((size, size))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        out = io.BytesIO()
+        image.save(out, 'JPEG', quality=85)
+        return out.getvalue()
+    except Exception:
+        return None
+
+
+class MediaMirror:
+    """Downloads the media queued in the media table on ``workers`` threads
+    and stores every file under ``root`` named by the SHA-256 of its content,
+    so a file linked from many URLs is stored once. Images also get a JPEG
+    thumbnail that fits ``thumbnail_size`` pixels.
+
+    ``enqueue()`` queues URLs on ``hosts`` in the caller's transaction, and
+    ``notify()`` wakes the workers once it has committed; otherwise they look
+    for work every ``poll_interval`` seconds. A worker claims one URL at a
+    time with SKIP LOCKED, which also schedules its retry ``retry_delay``
+    seconds later, doubled on every attempt. Downloads are retried up to
+    ``max_attempts`` times, except URLs the CDN refuses and files larger
+    than ``max_bytes``."""
+
+    def __init__(self, db_pool, root, hosts, workers=4, thumbnail_size=400,
+                 max_bytes=20 * 1024 * 1024, max_attempts=5, retry_delay=60,
+                 poll_interval=60, download=download):
+        self.db_pool = db_pool
+        self.root = root
+        self.hosts = set(hosts)
+        self.workers = workers
+        self.thumbnail_size = thumbnail_size
+        self.max_bytes = max_bytes
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.download = download
+        self.notified = 0
+        self.cond = threading.Condition()
+        self.started = False
+        self.stats = {'downloads': 0, 'bytes': 0, 'duplicates': 0,
+                      'thumbnails': 0, 'failures': 0}
+
+    def mirrorable(self, url):
+        parts = urllib.parse.urlsplit(url or '')
+        return parts.scheme in ('http', 'https') and parts.hostname in self.hosts
+
+    def path(self, sha256, thumbnail=False):
+        return os.path.join(self.root, sha256[:2],
+                            sha256 + ('.thumb.jpg' if thumbnail else ''))
+
+    def enqueue(self, cur, urls):
+        # Sorted, so concurrent syncs lock new rows in the same order.
+        urls = sorted(set(url for url in urls if self.mirrorable(url)))
+        if urls:
+            cur.execute(
+                "INSERT INTO media (url) SELECT unnest(%s::text[]) ON CONFLICT DO NOTHING;",
+                (urls,))
+
+    def notify(self):
+        with self.cond:
+            self.notified += 1
+            self.cond.notify_all()
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+
+    def run(self):
+        while True:
+            with self.cond:
+                notified = self.notified
+            try:
+                claimed = self.claim()
+                if claimed:
+                    self.mirror(*claimed)
+            except Exception:
+                traceback.print_exc()
+                claimed = None
+            if not claimed:
+                with self.cond:
+                    if self.notified == notified:
+                        self.cond.wait(self.poll_interval)
+
+    def claim(self):
+        """Claim the next due URL. Returns it with its number of attempts."""
+
+        with self.db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "UPDATE media SET attempts = attempts + 1, next_attempt = now() + %s * power(2, attempts) * interval '1 second' WHERE url = (SELECT url FROM media WHERE sha256 IS NULL AND next_attempt <= now() ORDER BY next_attempt LIMIT 1 FOR UPDATE SKIP LOCKED) RETURNING url, attempts;",
+                (self.retry_delay,))
+            claimed = cur.fetchone()
+            conn.commit()
+            return claimed
+
+    def mirror(self, url, attempts):
+        try:
+            data, content_type = self.download(url, self.max_bytes)
+        except (OSError, ValueError) as e:
+            # A 4xx means the URL expired, and a file too large stays so.
+            give_up = (isinstance(e, ValueError) or
+                       (isinstance(e, urllib.error.HTTPError) and 400 <= e.code < 500) or
+                       attempts >= self.max_attempts)
+            print("Media download failed:", url, e)
+            with self.cond:
+                self.stats['failures'] += 1
+            if give_up:
+                with self.db_pool.connection() as conn:
+                    cur = conn.cursor()
+                    cur.execute(
+                        "UPDATE media SET next_attempt = 'infinity' WHERE url = %s;",
+                        (url,))
+                    conn.commit()
+            return
+
+        sha256 = hashlib.sha256(data).hexdigest()
+        stored = os.path.exists(self.path(sha256))
+        if not stored:
+            self.write(self.path(sha256), data)
+        has_thumbnail = os.path.exists(self.path(sha256, True))
+        if not has_thumbnail and content_type.startswith('image/'):
+            small = thumbnail(data, self.thumbnail_size)
+            if small is not None:
+                self.write(self.path(sha256, True), small)
+                has_thumbnail = True
+                with self.cond:
+                    self.stats['thumbnails'] += 1
+
+        with self.db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "UPDATE media SET sha256 = %s, content_type = %s, thumbnail = %s, fetched_at = now() WHERE url = %s;",
+                (sha256,
+                 content_type,
+                 has_thumbnail,
+                 url))
+            conn.commit()
+        with self.cond:
+            self.stats['downloads'] += 1
+            if stored:
+                self.stats['duplicates'] += 1
+            else:
+                self.stats['bytes'] += len(data)
+
+    def write(self, path, data):
+        # Written under a temporary name first, so a file that exists is whole.
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)
+
+    def get_stats(self):
+        with self.cond:
+            return dict(self.stats)
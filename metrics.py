@@ -0,0 +1,150 @@
+# *------------------------------------------------------------------------------*
+# GroupMe Archiver: A web application to store and display GroupMe group histories
+# Copyright (C) 2016 Jordan Buchman
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# *------------------------------------------------------------------------------*
+
+
+# In-process counters, gauges and histograms for the /metrics endpoint,
+# rendered in the Prometheus text exposition format.
+
+import math
+import threading
+from collections import OrderedDict
+
+# Upper bounds of the default histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                   5, 10)
+
+
+class Metrics:
+    """A registry of metric families. Each family is declared once with
+    ``counter()``, ``gauge()`` or ``histogram()`` and then updated by name,
+    with its labels given as keyword arguments. Safe to update from any
+    thread."""
+
+    def __init__(self):
+        self.families = OrderedDict()
+        self.lock = threading.Lock()
+
+    def declare(self, name, type, help, buckets=None):
+        with self.lock:
+            self.families[name] = {'type': type, 'help': help,
+                                   'buckets': buckets, 'samples': {}}
+
+    def counter(self, name, help):
+        self.declare(name, 'counter', help)
+
+    def gauge(self, name, help):
+        self.declare(name, 'gauge', help)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.declare(name, 'histogram', help, tuple(buckets))
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            samples = self.families[name]['samples']
+            samples[key] = samples.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set a gauge, or a counter that is kept elsewhere (e.g. in a
+        component's stats) and only copied here when scraped."""
+
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.families[name]['samples'][key] = value
+
+    def remove(self, name, **labels):
+        """Stop exporting a sample, e.g. of a group this process no longer
+        syncs."""
+
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.families[name]['samples'].pop(key, None)
+
+    def set_stats(self, prefix, stats, help):
+        """Copy the numbers in a component's ``get_stats()`` dict into
+        untyped metrics named ``prefix_key``. Other values are skipped."""
+
+        for key, value in stats.items():
+            if not isinstance(value, (int, float)):
+                continue
+            name = '{0}_{1}'.format(prefix, key)
+            if name not in self.families:
+                self.declare(name, 'untyped', help)
+            self.set(name, value)
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.families[name]
+            sample = family['samples'].get(key)
+            if sample is None:
+                sample = family['samples'][key] = {
+                    'buckets': [0] * len(family['buckets']),
+                    'sum': 0.0,
+                    'count': 0}
+            for i, bound in enumerate(family['buckets']):
+                if value <= bound:
+                    sample['buckets'][i] += 1
+            sample['sum'] += value
+            sample['count'] += 1
+
+    def render(self):
+        """All metrics in the Prometheus text format (version 0.0.4)."""
+
+        lines = []
+        with self.lock:
+            for name, family in self.families.items():
+                lines.append('# HELP {0} {1}'.format(name, family['help']))
+                lines.append('# TYPE {0} {1}'.format(name, family['type']))
+                for key, sample in sorted(family['samples'].items()):
+                    if family['type'] != 'histogram':
+                        lines.append(line(name, key, sample))
+                        continue
+                    for bound, count in zip(family['buckets'], sample['buckets']):
+                        lines.append(line(name + '_bucket',
+                                          key + (('le', bound),), count))
+                    lines.append(line(name + '_bucket',
+                                      key + (('le', math.inf),), sample['count']))
+                    lines.append(line(name + '_sum', key, sample['sum']))
+                    lines.append(line(name + '_count', key, sample['count']))
+        return '\n'.join(lines) + '\n'
+
+
+def line(name, labels, value):
+    if labels:
+        name += '{' + ','.join(
+            '{0}="{1}"'.format(label, escape(number(label_value)
+                                             if label == 'le' else label_value))
+            for label, label_value in labels) + '}'
+    return '{0} {1}'.format(name, number(value))
+
+
+def number(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return str(value)
+
+
+def escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
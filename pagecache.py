@@ -0,0 +1,140 @@
+# *------------------------------------------------------------------------------*
+# GroupMe Archiver: A web application to store and display GroupMe group histories
+# Copyright (C) 2016 Jordan Buchman
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# *------------------------------------------------------------------------------*
+
+# Rendered timeline pages, invalidated by the sync job as it archives the
+# messages and likes they show.
+
+import threading
+from collections import OrderedDict
+
+
+class PageCache:
+    """LRU cache of rendered timeline pages holding at most ``max_bytes`` of
+    HTML.
+
+    Every entry records the range of message ids its page covers (unbounded
+    on a side where the page reached the end of its timeline) and the users
+    whose names it shows as likers. Archived history doesn't change, so an
+    entry stays valid until ``invalidate()`` reports messages archived or
+    likes changed within a range of ids overlapping its own, or
+    ``invalidate_users()`` one of its likers renamed. Pages deep in a group's
+    history are therefore served from the cache until they are evicted,
+    while the newest page of an active group is rendered again after every
+    sync that archives something.
+
+    Read ``generation(group_id)`` before querying a page and pass it to
+    ``put()``: a page rendered while the group was being invalidated is not
+    stored, as it may show the previous state."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.groups = {}
+        self.generations = {}
+        self.users_generation = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0,
+                      'invalidations': 0}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry['value']
+
+    def generation(self, group_id):
+        with self.lock:
+            return self.generations.get(group_id, 0), self.users_generation
+
+    def put(self, key, group_id, generation, value, size, low, high, users):
+        """Store a page of ``size`` bytes covering message ids ``low`` to
+        ``high`` (None for unbounded) with likes by ``users``."""
+
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if generation != (self.generations.get(group_id, 0),
+                              self.users_generation):
+                return
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = {
+                'group_id': group_id,
+                'value': value,
+                'size': size,
+                'low': float('-inf') if low is None else low,
+                'high': float('inf') if high is None else high,
+                'users': frozenset(users)}
+            self.groups.setdefault(group_id, set()).add(key)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.stats['evictions'] += 1
+
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        self.bytes -= entry['size']
+        keys = self.groups[entry['group_id']]
+        keys.discard(key)
+        if not keys:
+            del self.groups[entry['group_id']]
+
+    def invalidate(self, group_id, low, high):
+        """Drop the group's pages overlapping message ids ``low`` to
+        ``high``, which had messages archived or likes changed."""
+
+        with self.lock:
+            self.generations[group_id] = self.generations.get(group_id, 0) + 1
+            for key in list(self.groups.get(group_id, ())):
+                entry = self.entries[key]
+                if entry['low'] <= high and low <= entry['high']:
+                    self.remove(key)
+                    self.stats['invalidations'] += 1
+
+    def invalidate_users(self, user_ids):
+        """Drop pages showing any of ``user_ids`` as likers."""
+
+        user_ids = set(user_ids)
+        if not user_ids:
+            return
+        with self.lock:
+            self.users_generation += 1
+            for key in [key for key, entry in self.entries.items()
+                        if not entry['users'].isdisjoint(user_ids)]:
+                self.remove(key)
+                self.stats['invalidations'] += 1
+
+    def clear(self):
+        """Drop every page, e.g. when invalidations may have been missed."""
+
+        with self.lock:
+            self.users_generation += 1
+            self.entries.clear()
+            self.groups.clear()
+            self.bytes = 0
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['pages'] = len(self.entries)
+            stats['bytes'] = self.bytes
+            return stats
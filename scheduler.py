@@ -0,0 +1,189 @@
+# *------------------------------------------------------------------------------*
+# GroupMe Archiver: A web application to store and display GroupMe group histories
+# Copyright (C) 2016 Jordan Buchman
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# *------------------------------------------------------------------------------*
+
+# Periodic sync of archived groups on a fixed number of worker threads.
+
+import heapq
+import queue
+import random
+import threading
+import time
+import traceback
+
+
+class SyncScheduler:
+    """Runs ``sync(group_id, type)`` for every added group, forever.
+
+    At most ``workers`` syncs run at once and a group is never queued or run
+    twice concurrently. ``sync`` returns the number of new messages it
+    archived: groups that had new messages are polled again after
+    ``interval`` seconds, quiet (or failing) groups back off exponentially up
+    to ``max_interval``. Every delay is spread by +/- ``jitter`` so groups
+    don't stay in lockstep. ``remove()`` hands a group back, e.g. to another
+    syncing process, and ``on_remove(group_id)`` is called once it is
+    dropped."""
+
+    def __init__(self, sync, workers=4, interval=60, max_interval=900,
+                 jitter=0.2, on_remove=None):
+        self.sync = sync
+        self.on_remove = on_remove
+        self.workers = workers
+        self.interval = interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.groups = {}
+        self.due = []
+        self.work = queue.Queue()
+        self.cond = threading.Condition()
+        self.started = False
+
+    def __contains__(self, group_id):
+        with self.cond:
+            return group_id in self.groups
+
+    def add(self, group_id, type, delay=0):
+        with self.cond:
+            if group_id in self.groups:
+                # Still finishing a sync after remove(): keep it instead.
+                if self.groups[group_id]['removed']:
+                    self.groups[group_id]['removed'] = False
+                    return True
+                return False
+            next_run = time.time() + delay
+            self.groups[group_id] = {
+                'type': type,
+                'interval': self.interval,
+                'next_run': next_run,
+                'queued_at': None,
+                'running': False,
+                'runs': 0,
+                'failures': 0,
+                'last_finished': None,
+                'last_new_messages': None,
+                'removed': False}
+            heapq.heappush(self.due, (next_run, group_id))
+            self.cond.notify()
+            return True
+
+    def remove(self, group_id, only_idle=False):
+        """Stop syncing a group. A group that is queued or running is dropped
+        once its sync finishes, or with ``only_idle`` left alone. Returns
+        whether the group was dropped right away."""
+
+        with self.cond:
+            state = self.groups.get(group_id)
+            if state is None:
+                return True
+            if state['queued_at'] or state['running']:
+                if not only_idle:
+                    state['removed'] = True
+                return False
+            self.drop(group_id)
+            return True
+
+    def drop(self, group_id):
+        del self.groups[group_id]
+        if self.on_remove:
+            self.on_remove(group_id)
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        threads = [threading.Thread(target=self.dispatch)]
+        threads += [threading.Thread(target=self.work_loop)
+                    for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+    def dispatch(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                while self.due and self.due[0][0] <= now:
+                    due, group_id = heapq.heappop(self.due)
+                    state = self.groups.get(group_id)
+                    # Skip removed groups, entries superseded by a later
+                    # reschedule, and groups that are already waiting or
+                    # running.
+                    if (state is None or due != state['next_run'] or
+                            state['queued_at'] or state['running']):
+                        continue
+                    state['queued_at'] = now
+                    self.work.put(group_id)
+                self.cond.wait(self.due[0][0] - now if self.due else None)
+
+    def work_loop(self):
+        while True:
+            group_id = self.work.get()
+            with self.cond:
+                state = self.groups[group_id]
+                state['queued_at'] = None
+                if state['removed']:
+                    self.drop(group_id)
+                    continue
+                state['running'] = True
+            new_messages = None
+            try:
+                new_messages = self.sync(group_id, state['type'])
+            except Exception:
+                traceback.print_exc()
+            with self.cond:
+                state['running'] = False
+                state['runs'] += 1
+                state['last_finished'] = time.time()
+                state['last_new_messages'] = new_messages
+                if new_messages is None:
+                    state['failures'] += 1
+                if state['removed']:
+                    self.drop(group_id)
+                    continue
+                if new_messages:
+                    state['interval'] = self.interval
+                else:
+                    state['interval'] = min(state['interval'] * 2,
+                                            self.max_interval)
+                delay = state['interval'] * random.uniform(
+                    1 - self.jitter, 1 + self.jitter)
+                state['next_run'] = time.time() + delay
+                heapq.heappush(self.due, (state['next_run'], group_id))
+                self.cond.notify()
+
+    def stats(self):
+        """Queue depth, running syncs and scheduling lag. A group's lag is how
+        long it has been overdue, i.e. waiting for a free worker."""
+
+        now = time.time()
+        with self.cond:
+            groups = {}
+            for group_id, state in self.groups.items():
+                groups[group_id] = {
+                    'type': state['type'],
+                    'interval': state['interval'],
+                    'running': state['running'],
+                    'lag': max(now - state['next_run'], 0) if not state['running'] else 0,
+                    'runs': state['runs'],
+                    'failures': state['failures'],
+                    'last_finished': state['last_finished'],
+                    'last_new_messages': state['last_new_messages']}
+            return {
+                'workers': self.workers,
+                'queue_depth': self.work.qsize(),
+                'running': sum(1 for state in self.groups.values() if state['running']),
+                'max_lag': max([group['lag'] for group in groups.values()] or [0]),
+                'groups': groups}
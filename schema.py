@@ -0,0 +1,575 @@
+# *------------------------------------------------------------------------------*
+# GroupMe Archiver: A web application to store and display GroupMe group histories
+# Copyright (C) 2016 Jordan Buchman
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# *------------------------------------------------------------------------------*
+
+# Versioned database schema. Every migration runs once, in its own
+# transaction, and the versions applied so far are recorded in the
+# schema_version table. Indexes are declared separately (see INDEXES) and
+# created after the migrations, optionally CONCURRENTLY on a live archive.
+#
+#   python schema.py database [username] [password] [--concurrently] [--check]
+
+import argparse
+import ast
+import json
+import re
+import sys
+
+import psycopg2
+
+from ingest import attachment_row, copy_rows
+
+# Text search configuration used by the message search index
+SEARCH_CONFIG = 'english'
+SEARCH_VECTOR = "to_tsvector('{0}', message)".format(SEARCH_CONFIG)
+
+# Key of the advisory lock held while migrating, so that processes starting
+# at the same time don't migrate concurrently
+MIGRATION_LOCK = 1606400
+
+# Key of the advisory lock held while building indexes. Concurrent builds
+# take long and can deadlock each other on the same table, so only one
+# process builds at a time and the others leave the indexes to it.
+INDEX_LOCK = 1606402
+
+# Number of messages whose attachments are converted per round trip by
+# migration 2
+BACKFILL_BATCH_SIZE = 5000
+
+
+def create_tables(cur):
+    """The schema as it was before versioning. Every statement is idempotent,
+    so this also brings up to date archives created by older versions."""
+
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS messages(
+        id text PRIMARY KEY,
+        name text,
+        message text,
+        attachments text[],
+        avatar_url text,
+        created_at timestamp with time zone,
+        user_id text,
+        group_id text,
+        likes text[]
+      )
+    """)
+
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS members(
+        user_id text,
+        nickname text,
+        avatar text,
+        group_id text,
+        UNIQUE (user_id, group_id)
+      )
+    """)
+
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS groups(
+        name text,
+        image_url text,
+        description text,
+        id text PRIMARY KEY,
+        type text,
+        archived boolean NOT NULL DEFAULT true,
+        message_count integer
+      )
+    """)
+
+    # Groups and DM partners that aren't archived are listed too (archived =
+    # false), see store_directory()
+    cur.execute(
+        "ALTER TABLE groups ADD COLUMN IF NOT EXISTS archived boolean NOT NULL DEFAULT true;")
+    cur.execute(
+        "ALTER TABLE groups ADD COLUMN IF NOT EXISTS message_count integer;")
+
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS sync_state(
+        group_id text PRIMARY KEY,
+        newest_id text,
+        oldest_id text,
+        backfill_complete boolean DEFAULT false
+      )
+    """)
+
+    # First and last message dates of each group's timeline (user_id '') and
+    # of each member's timeline within it, kept up to date by the sync job
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS timeline_bounds(
+        group_id text,
+        user_id text,
+        start_date timestamp with time zone,
+        end_date timestamp with time zone,
+        message_count bigint,
+        PRIMARY KEY (group_id, user_id)
+      )
+    """)
+
+    # Timelines are paged by numeric message id
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS messages_group_id_idx ON messages (group_id, (id::bigint));")
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS messages_member_id_idx ON messages (group_id, user_id, (id::bigint));")
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS messages_search_idx ON messages USING gin (" + SEARCH_VECTOR + ");")
+
+
+def attachment_from_repr(text):
+    """Recover an attachment that was archived as its GroupyAPI repr, e.g.
+    "Image(url='https://i.groupme.com/...')". Attachments of unknown types
+    were archived as a bare object repr and only keep their type."""
+
+    try:
+        call = ast.parse(text, mode='eval').body
+        args = [ast.literal_eval(arg) for arg in call.args]
+        attachment = dict((keyword.arg, ast.literal_eval(keyword.value))
+                          for keyword in call.keywords)
+        type = call.func.id.lower()
+    except (SyntaxError, ValueError, AttributeError):
+        return {'type': 'unknown'}
+    if type == 'mentions' and args:
+        attachment['user_ids'] = args[0]
+    attachment['type'] = type
+    return attachment
+
+
+def normalize_messages(cur):
+    """Store message ids as bigint, and likes and attachments in tables of
+    their own instead of as text arrays."""
+
+    cur.execute("""
+      CREATE TABLE message_likes(
+        message_id bigint,
+        user_id text,
+        PRIMARY KEY (message_id, user_id)
+      )
+    """)
+    cur.execute("""
+      CREATE TABLE message_attachments(
+        message_id bigint,
+        position smallint,
+        type text NOT NULL,
+        url text,
+        name text,
+        lat double precision,
+        lng double precision,
+        user_ids text[],
+        data jsonb,
+        PRIMARY KEY (message_id, position)
+      )
+    """)
+
+    cur.execute(
+        "INSERT INTO message_likes SELECT DISTINCT id::bigint, unnest(likes) FROM messages;")
+
+    # The reprs are parsed here rather than in SQL; read them in batches on
+    # a server-side cursor so large archives aren't loaded at once.
+    source = cur.connection.cursor('attachments_backfill')
+    source.execute(
+        "SELECT id::bigint, attachments FROM messages WHERE cardinality(attachments) > 0;")
+    while True:
+        batch = source.fetchmany(BACKFILL_BATCH_SIZE)
+        if not batch:
+            break
+        copy_rows(cur, "message_attachments",
+                  [attachment_row(id, position, attachment_from_repr(text))
+                   for id, attachments in batch
+                   for position, text in enumerate(attachments)])
+    source.close()
+
+    # The timeline indexes on id::bigint are declared again on id, see
+    # INDEXES.
+    cur.execute("DROP INDEX IF EXISTS messages_group_id_idx, messages_member_id_idx;")
+    cur.execute(
+        "ALTER TABLE messages ALTER COLUMN id TYPE bigint USING id::bigint, DROP COLUMN attachments, DROP COLUMN likes;")
+    cur.execute(
+        "ALTER TABLE message_likes ADD FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE CASCADE;")
+    cur.execute(
+        "ALTER TABLE message_attachments ADD FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE CASCADE;")
+
+
+def create_message_days(cur):
+    """Per-day message counts of each group (user_id '') and of each member
+    within it, by UTC day, kept up to date by the sync job."""
+
+    cur.execute("""
+      CREATE TABLE message_days(
+        group_id text,
+        user_id text,
+        day date,
+        message_count integer,
+        PRIMARY KEY (group_id, user_id, day)
+      )
+    """)
+    cur.execute("""
+      INSERT INTO message_days
+      SELECT group_id, CASE WHEN GROUPING(user_id) = 1 THEN '' ELSE user_id END, day, count(*)
+      FROM (SELECT group_id, user_id, (created_at AT TIME ZONE 'UTC')::date AS day FROM messages) m
+      GROUP BY GROUPING SETS ((group_id, day), (group_id, user_id, day))
+    """)
+
+
+def add_like_rollups(cur):
+    """Count likes in message_days too, by the day of the liked message:
+    likes_received by its author and likes_given by the liker. On the
+    group's own rows (user_id '') both are the group's total likes."""
+
+    cur.execute(
+        "ALTER TABLE message_days ADD COLUMN likes_received integer NOT NULL DEFAULT 0, ADD COLUMN likes_given integer NOT NULL DEFAULT 0;")
+    cur.execute("""
+      INSERT INTO message_days (group_id, user_id, day, message_count, likes_received, likes_given)
+      SELECT group_id, CASE WHEN GROUPING(user_id) = 1 THEN '' ELSE user_id END, day, 0, count(*),
+             CASE WHEN GROUPING(user_id) = 1 THEN count(*) ELSE 0 END
+      FROM (SELECT m.group_id, m.user_id, (m.created_at AT TIME ZONE 'UTC')::date AS day
+            FROM message_likes l JOIN messages m ON m.id = l.message_id) liked
+      GROUP BY GROUPING SETS ((group_id, day), (group_id, user_id, day))
+      ON CONFLICT (group_id, user_id, day) DO UPDATE
+      SET likes_received = EXCLUDED.likes_received, likes_given = EXCLUDED.likes_given
+    """)
+    cur.execute("""
+      INSERT INTO message_days (group_id, user_id, day, message_count, likes_given)
+      SELECT m.group_id, l.user_id, (m.created_at AT TIME ZONE 'UTC')::date, 0, count(*)
+      FROM message_likes l JOIN messages m ON m.id = l.message_id
+      GROUP BY 1, 2, 3
+      ON CONFLICT (group_id, user_id, day) DO UPDATE SET likes_given = EXCLUDED.likes_given
+    """)
+
+
+def add_sync_modified_at(cur):
+    """When each group's archive last changed, for conditional responses."""
+
+    cur.execute(
+        "ALTER TABLE sync_state ADD COLUMN modified_at timestamp with time zone NOT NULL DEFAULT now();")
+
+
+def create_import_state(cur):
+    """Progress of archive imports, so an interrupted import of an export
+    file resumes after the last committed batch, see transfer.py."""
+
+    cur.execute("""
+      CREATE TABLE import_state(
+        export_id text,
+        group_id text,
+        last_id bigint,
+        PRIMARY KEY (export_id, group_id)
+      )
+    """)
+
+
+def create_media(cur):
+    """Images and avatars mirrored from GroupMe's CDN, see media.py. Rows
+    without a sha256 are waiting to be downloaded. Everything already
+    archived is queued."""
+
+    cur.execute("""
+      CREATE TABLE media(
+        url text PRIMARY KEY,
+        sha256 text,
+        content_type text,
+        thumbnail boolean NOT NULL DEFAULT false,
+        attempts integer NOT NULL DEFAULT 0,
+        next_attempt timestamp with time zone NOT NULL DEFAULT now(),
+        fetched_at timestamp with time zone
+      )
+    """)
+    cur.execute("""
+      INSERT INTO media (url)
+      SELECT url FROM (
+        SELECT avatar_url AS url FROM messages
+        UNION SELECT url FROM message_attachments WHERE type IN ('image', 'linked_image')
+        UNION SELECT avatar FROM members
+        UNION SELECT image_url FROM groups) urls
+      WHERE url LIKE 'https://i.groupme.com/%'
+    """)
+
+
+def create_sync_leases(cur):
+    """Workers syncing the archive and the groups each of them has claimed,
+    see leases.py. A row is live until its ``expires_at``."""
+
+    cur.execute("""
+      CREATE TABLE sync_workers(
+        id text PRIMARY KEY,
+        expires_at timestamp with time zone NOT NULL
+      )
+    """)
+    cur.execute("""
+      CREATE TABLE sync_leases(
+        group_id text PRIMARY KEY,
+        owner text,
+        expires_at timestamp with time zone NOT NULL
+      )
+    """)
+
+
+MIGRATIONS = [
+    (1, create_tables),
+    (2, normalize_messages),
+    (3, create_message_days),
+    (4, add_like_rollups),
+    (5, add_sync_modified_at),
+    (6, create_import_state),
+    (7, create_media),
+    (8, create_sync_leases)]
+
+# Every index the views rely on, by name, and the query shapes they serve
+INDEXES = [
+    # Group timeline pages: WHERE group_id = ? AND id < ? ORDER BY id
+    ('messages_group_id_idx', "messages (group_id, id)"),
+    # Member timeline pages, and a DM partner's newest message
+    ('messages_member_id_idx', "messages (group_id, user_id, id)"),
+    # Jump to a date: WHERE group_id = ? AND created_at >= ? ORDER BY created_at
+    ('messages_group_created_at_idx', "messages (group_id, created_at, id)"),
+    ('messages_member_created_at_idx', "messages (group_id, user_id, created_at, id)"),
+    # Search
+    ('messages_search_idx', "messages USING gin (" + SEARCH_VECTOR + ")"),
+    # Messages liked by a member (likes of a message use the primary key)
+    ('message_likes_user_id_idx', "message_likes (user_id, message_id)"),
+    # Member list of a group (members of a user use the unique constraint on
+    # (user_id, group_id))
+    ('members_group_id_idx', "members (group_id)"),
+    # Downloads waiting for the media mirror
+    ('media_pending_idx', "media (next_attempt) WHERE sha256 IS NULL")]
+
+
+def migrate(conn, concurrently=False):
+    """Apply every migration the database hasn't seen yet, in order, then
+    create the declared indexes that are missing. Both happen under
+    MIGRATION_LOCK, except concurrent index builds, which can take long
+    enough that other processes shouldn't wait for them."""
+
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK,))
+    try:
+        cur.execute("""
+          CREATE TABLE IF NOT EXISTS schema_version(
+            version integer PRIMARY KEY,
+            applied_at timestamp with time zone DEFAULT now()
+          )
+        """)
+        cur.execute("SELECT version FROM schema_version;")
+        applied = set(row[0] for row in cur.fetchall())
+        conn.commit()
+        for version, migration in MIGRATIONS:
+            if version in applied:
+                continue
+            print("Applying migration", version, migration.__name__)
+            try:
+                migration(cur)
+                cur.execute(
+                    "INSERT INTO schema_version (version) VALUES (%s);", (version,))
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+        if not concurrently:
+            create_indexes(conn)
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK,))
+        conn.commit()
+    if concurrently:
+        create_indexes(conn, concurrently)
+
+
+def create_indexes(conn, concurrently=False):
+    """Create the declared indexes that don't exist yet. With
+    ``concurrently``, indexes are built without blocking writes to their
+    table (but more slowly), so the app can keep archiving meanwhile. An
+    index left invalid by an interrupted concurrent build is rebuilt.
+
+    Nothing is built while another process holds INDEX_LOCK: its builds
+    look like invalid indexes until they're done, so they are left to it."""
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction.
+    autocommit = conn.autocommit
+    conn.autocommit = concurrently
+    option = "CONCURRENTLY " if concurrently else ""
+    try:
+        cur = conn.cursor()
+        missing = [(name, definition) for name, definition in INDEXES
+                   if not index_valid(cur, name)]
+        conn.commit()
+        if not missing:
+            return
+        cur.execute("SELECT pg_try_advisory_lock(%s);", (INDEX_LOCK,))
+        if not cur.fetchone()[0]:
+            conn.commit()
+            print("Indexes are being built by another process")
+            return
+        try:
+            for name, definition in missing:
+                # It may have been built before we took the lock.
+                valid = index_valid(cur, name)
+                if valid:
+                    continue
+                if valid is False:
+                    print("Rebuilding invalid index", name)
+                    cur.execute("DROP INDEX " + option + name + ";")
+                else:
+                    print("Creating index", name)
+                try:
+                    cur.execute("CREATE INDEX " + option + name + " ON " + definition + ";")
+                except psycopg2.errors.DuplicateTable:
+                    # Built by a process that doesn't take the lock.
+                    if not concurrently:
+                        raise
+                    if not index_valid(cur, name):
+                        print("Index", name, "is being built by another process")
+            conn.commit()
+        finally:
+            # A failed build aborted the transaction.
+            conn.rollback()
+            cur.execute("SELECT pg_advisory_unlock(%s);", (INDEX_LOCK,))
+            conn.commit()
+    finally:
+        conn.autocommit = autocommit
+
+
+def index_valid(cur, name):
+    """True if the index exists and is usable, False if it exists but is
+    invalid (or still being built), None if it doesn't exist."""
+
+    cur.execute(
+        "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s);",
+        (name,))
+    index = cur.fetchone()
+    return index[0] if index else None
+
+
+# Tables with fewer rows than this are expected to be read sequentially
+SMALL_TABLE_ROWS = 10000
+
+# Query shapes of the views, with the parameters filled in from a sample
+# message by check_queries()
+CHECKS = [
+    ('group timeline',
+     "SELECT * FROM messages WHERE group_id = %(group_id)s ORDER BY id DESC LIMIT 10"),
+    ('group timeline, older page',
+     "SELECT * FROM messages WHERE group_id = %(group_id)s AND id < %(id)s ORDER BY id DESC LIMIT 10"),
+    ('group timeline, newer page',
+     "SELECT * FROM messages WHERE group_id = %(group_id)s AND id > %(id)s ORDER BY id ASC LIMIT 10"),
+    ('member timeline',
+     "SELECT * FROM messages WHERE user_id = %(user_id)s AND group_id = %(group_id)s AND id <= %(id)s ORDER BY id DESC LIMIT 10"),
+    ('group date jump',
+     "SELECT id FROM messages WHERE group_id = %(group_id)s AND created_at >= %(created_at)s ORDER BY created_at ASC, id ASC LIMIT 1"),
+    ('member date jump',
+     "SELECT id FROM messages WHERE user_id = %(user_id)s AND group_id = %(group_id)s AND created_at >= %(created_at)s ORDER BY created_at ASC, id ASC LIMIT 1"),
+    ('search',
+     "SELECT * FROM messages WHERE group_id = %(group_id)s AND " + SEARCH_VECTOR +
+     " @@ to_tsquery('" + SEARCH_CONFIG + "', %(word)s) ORDER BY id DESC LIMIT 10"),
+    ('likes of a message',
+     "SELECT user_id FROM message_likes WHERE message_id = %(id)s"),
+    ('attachments of a message',
+     "SELECT * FROM message_attachments WHERE message_id = %(id)s ORDER BY position"),
+    ('messages liked by a member',
+     "SELECT message_id FROM message_likes WHERE user_id = %(user_id)s ORDER BY message_id DESC LIMIT 10"),
+    ('likers',
+     "SELECT DISTINCT ON (user_id) user_id, nickname, avatar FROM members WHERE user_id = ANY(%(user_ids)s) ORDER BY user_id, group_id = %(group_id)s DESC"),
+    ('group members',
+     "SELECT * FROM members WHERE group_id = %(group_id)s"),
+    ('timeline bounds',
+     "SELECT start_date, end_date FROM timeline_bounds WHERE group_id = %(group_id)s AND user_id = %(user_id)s"),
+    ('calendar',
+     "SELECT date_trunc('month', day)::date, sum(message_count) FROM message_days WHERE group_id = %(group_id)s AND user_id = '' GROUP BY 1 ORDER BY 1"),
+    ('group stats',
+     "SELECT user_id, sum(message_count), sum(likes_received), sum(likes_given) FROM message_days WHERE group_id = %(group_id)s GROUP BY user_id")]
+
+
+def seq_scans(plan):
+    """Names of the tables a JSON query plan reads sequentially."""
+
+    tables = []
+    if plan.get('Node Type') == 'Seq Scan':
+        tables.append(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        tables.extend(seq_scans(child))
+    return tables
+
+
+def explain(cur, query, params):
+    cur.execute("EXPLAIN (FORMAT JSON) " + query, params)
+    plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return seq_scans(plan[0]['Plan'])
+
+
+def check_queries(conn):
+    """EXPLAIN every query shape in CHECKS and report sequential scans.
+    Returns the number of queries that read a table of SMALL_TABLE_ROWS
+    rows or more sequentially."""
+
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT id, group_id, user_id, created_at, message FROM messages ORDER BY id DESC LIMIT 1;")
+    sample = cur.fetchone()
+    if not sample:
+        print("The archive is empty, nothing to check.")
+        return 0
+    id, group_id, user_id, created_at, message = sample
+    words = re.findall(r'[a-zA-Z]{4,}', message or '')
+    params = {'id': id,
+              'group_id': group_id,
+              'user_id': user_id,
+              'user_ids': [user_id],
+              'created_at': created_at,
+              'word': words[0].lower() if words else 'groupme'}
+
+    failures = 0
+    for name, query in CHECKS:
+        tables = explain(cur, query, params)
+        if not tables:
+            print("ok       ", name)
+            continue
+        cur.execute(
+            "SELECT relname, reltuples FROM pg_class WHERE relname = ANY(%s);",
+            (tables,))
+        sizes = dict(cur.fetchall())
+        scans = ", ".join("{0} ({1:.0f} rows)".format(table, sizes.get(table, 0))
+                          for table in tables)
+        # The planner rightly reads small tables sequentially.
+        if all(sizes.get(table, 0) < SMALL_TABLE_ROWS for table in tables):
+            print("small    ", name, "- sequential scan of", scans)
+        else:
+            failures += 1
+            print("SEQ SCAN ", name, "- sequential scan of", scans)
+    conn.rollback()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Migrate the archive's schema and create missing indexes.")
+    parser.add_argument('database')
+    parser.add_argument('user', nargs='?')
+    parser.add_argument('password', nargs='?')
+    parser.add_argument('--concurrently', action='store_true',
+                        help="build indexes without blocking the running app")
+    parser.add_argument('--check', action='store_true',
+                        help="only EXPLAIN the views' queries and report sequential scans")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(
+        database=args.database,
+        user=args.user,
+        password=args.password)
+    if args.check:
+        sys.exit(1 if check_queries(conn) else 0)
+    migrate(conn, concurrently=args.concurrently)
+
+if __name__ == "__main__":
+    main()
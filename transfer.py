@@ -0,0 +1,354 @@
+# *------------------------------------------------------------------------------*
+# GroupMe Archiver: A web application to store and display GroupMe group histories
+# Copyright (C) 2016 Jordan Buchman
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# *------------------------------------------------------------------------------*
+
+# Moving archived groups between instances. An export is a gzip-compressed
+# stream of JSON records, one per line: a header, then for every group its
+# groups row and sync state, its members, its messages in id order and an
+# end record with the number of messages.
+#
+#   python app.py export database [username] [password] [-g GROUP_ID ...] [-o FILE]
+#   python app.py import database [username] [password] [-i FILE]
+
+import argparse
+import contextlib
+import gzip
+import io
+import json
+import sys
+import uuid
+from datetime import datetime, timezone
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from ingest import (attachment_row, bulk_insert_messages, bulk_upsert_groups,
+                    bulk_upsert_members)
+from schema import migrate
+
+# Version of the export format written, and the newest one read
+FORMAT_VERSION = 1
+
+# Messages fetched from the server-side cursor per round trip by exports,
+# and written per transaction by imports
+TRANSFER_BATCH_SIZE = 10000
+
+# gzip level of exports; higher levels cost a lot more CPU for a little
+# smaller file
+COMPRESS_LEVEL = 6
+
+
+def write_record(stream, record):
+    stream.write(json.dumps(record, separators=(',', ':')))
+    stream.write('\n')
+
+
+def export(conn, group_ids, out):
+    """Write groups (every archived group if ``group_ids`` is empty) to the
+    binary file ``out``. Everything is read from one snapshot, and messages
+    through a server-side cursor, so memory use doesn't grow with the size
+    of the groups. Returns the number of messages written."""
+
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    if not group_ids:
+        cur.execute("SELECT id FROM groups WHERE archived ORDER BY id;")
+        group_ids = [row['id'] for row in cur.fetchall()]
+
+    total = 0
+    with io.TextIOWrapper(gzip.GzipFile(fileobj=out, mode='wb',
+                                        compresslevel=COMPRESS_LEVEL),
+                          encoding='utf-8') as stream:
+        write_record(stream, {
+            'type': 'header',
+            'version': FORMAT_VERSION,
+            'export_id': uuid.uuid4().hex,
+            'created_at': datetime.now(timezone.utc).isoformat()})
+        for group_id in group_ids:
+            cur.execute("SELECT * FROM groups WHERE id = %s;", (group_id,))
+            group = cur.fetchone()
+            if group is None:
+                raise ValueError("No group or DM partner " + group_id)
+            cur.execute(
+                "SELECT newest_id, oldest_id, backfill_complete FROM sync_state WHERE group_id = %s;",
+                (group_id,))
+            write_record(stream, {'type': 'group', 'group': group,
+                                  'sync_state': cur.fetchone()})
+
+            cur.execute(
+                "SELECT user_id, nickname, avatar FROM members WHERE group_id = %s;",
+                (group_id,))
+            for member in cur.fetchall():
+                member['type'] = 'member'
+                write_record(stream, member)
+
+            messages = conn.cursor('export_messages', cursor_factory=RealDictCursor)
+            messages.itersize = TRANSFER_BATCH_SIZE
+            messages.execute(
+                "SELECT id, name, message, avatar_url, created_at, user_id, "
+                "ARRAY(SELECT user_id FROM message_likes WHERE message_id = messages.id) AS likes, "
+                "ARRAY(SELECT data FROM message_attachments WHERE message_id = messages.id ORDER BY position) AS attachments "
+                "FROM messages WHERE group_id = %s ORDER BY id;",
+                (group_id,))
+            count = 0
+            for msg in messages:
+                write_record(stream, {
+                    'type': 'message',
+                    'id': str(msg['id']),
+                    'name': msg['name'],
+                    'text': msg['message'],
+                    'avatar_url': msg['avatar_url'],
+                    'created_at': msg['created_at'].isoformat(),
+                    'user_id': msg['user_id'],
+                    'likes': msg['likes'],
+                    'attachments': msg['attachments']})
+                count += 1
+            messages.close()
+
+            write_record(stream, {'type': 'end', 'group_id': group_id,
+                                  'messages': count})
+            print("Exported", group_id, count, file=sys.stderr)
+            total += count
+    conn.rollback()
+    return total
+
+
+def import_archive(conn, infile):
+    """Load an export from the binary file ``infile``. Messages are COPYed
+    in batches of TRANSFER_BATCH_SIZE, each committed together with the
+    import's progress in import_state, so importing the same file again
+    resumes after the last committed batch. Returns the number of messages
+    imported."""
+
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    export_id = None
+    group = None
+    total = 0
+    with io.TextIOWrapper(gzip.GzipFile(fileobj=infile, mode='rb'),
+                          encoding='utf-8') as stream:
+        for line in stream:
+            record = json.loads(line)
+            type = record['type']
+            if type == 'header':
+                if record['version'] > FORMAT_VERSION:
+                    raise ValueError(
+                        "Export format {0} is newer than this version of the app".format(
+                            record['version']))
+                export_id = record['export_id']
+            elif type == 'group':
+                group = start_group(cur, export_id, record)
+            elif type == 'member':
+                group['members'].append((record['user_id'],
+                                         record['nickname'],
+                                         record['avatar'],
+                                         group['id']))
+            elif type == 'message':
+                id = int(record['id'])
+                if group['last_id'] is not None and id <= group['last_id']:
+                    continue
+                group['rows'].append((id,
+                                      record['name'],
+                                      record['text'],
+                                      record['avatar_url'],
+                                      record['created_at'],
+                                      record['user_id'],
+                                      group['id']))
+                group['likes'] += [(id, user_id) for user_id in record['likes']]
+                group['attachments'] += [attachment_row(id, position, attachment)
+                                         for position, attachment in
+                                         enumerate(record['attachments'])]
+                if len(group['rows']) >= TRANSFER_BATCH_SIZE:
+                    total += flush_messages(cur, export_id, group)
+            elif type == 'end':
+                total += flush_messages(cur, export_id, group)
+                finish_group(cur, group, record['messages'])
+                group = None
+    if group is not None:
+        raise ValueError("The export of " + group['id'] + " is truncated")
+    return total
+
+
+def start_group(cur, export_id, record):
+    """List an imported group and look up how far an earlier import of the
+    same export got."""
+
+    row = record['group']
+    bulk_upsert_groups(cur, [(row['name'],
+                              row['image_url'],
+                              row['description'],
+                              row['id'],
+                              row['type'],
+                              False,
+                              row['message_count'])])
+    cur.execute(
+        "SELECT last_id FROM import_state WHERE export_id = %s AND group_id = %s;",
+        (export_id,
+         row['id']))
+    progress = cur.fetchone()
+    cur.connection.commit()
+    return {'id': row['id'],
+            'sync_state': record['sync_state'],
+            'last_id': progress['last_id'] if progress else None,
+            'members': [],
+            'rows': [],
+            'likes': [],
+            'attachments': []}
+
+
+def flush_messages(cur, export_id, group):
+    if not group['rows']:
+        return 0
+    inserted = bulk_insert_messages(cur, group['rows'], group['likes'],
+                                    group['attachments'])
+    group['last_id'] = group['rows'][-1][0]
+    cur.execute(
+        "INSERT INTO import_state VALUES (%s, %s, %s) ON CONFLICT (export_id, group_id) DO UPDATE SET last_id = EXCLUDED.last_id;",
+        (export_id,
+         group['id'],
+         group['last_id']))
+    cur.connection.commit()
+    group['rows'] = []
+    group['likes'] = []
+    group['attachments'] = []
+    return len(inserted)
+
+
+def finish_group(cur, group, exported):
+    """Store the members and sync state of an imported group, rebuild its
+    rollups and list it as archived."""
+
+    group_id = group['id']
+    bulk_upsert_members(cur, group['members'])
+
+    state = group['sync_state']
+    if state:
+        # The sync job carries on from the combined range of messages, unless
+        # the archive already had newer messages that don't reach back to
+        # the imported ones: its own backfill fills the gap then.
+        cur.execute(
+            "INSERT INTO sync_state (group_id, newest_id, oldest_id, backfill_complete) VALUES (%s, %s, %s, %s) "
+            "ON CONFLICT (group_id) DO UPDATE SET "
+            "newest_id = GREATEST(sync_state.newest_id::bigint, EXCLUDED.newest_id::bigint)::text, "
+            "oldest_id = CASE WHEN sync_state.oldest_id IS NULL OR sync_state.oldest_id::bigint <= EXCLUDED.newest_id::bigint "
+            "THEN LEAST(sync_state.oldest_id::bigint, EXCLUDED.oldest_id::bigint)::text ELSE sync_state.oldest_id END, "
+            "backfill_complete = sync_state.backfill_complete OR (EXCLUDED.backfill_complete AND "
+            "(sync_state.oldest_id IS NULL OR sync_state.oldest_id::bigint <= EXCLUDED.newest_id::bigint)), "
+            "modified_at = now();",
+            (group_id,
+             state['newest_id'],
+             state['oldest_id'],
+             state['backfill_complete']))
+
+    rebuild_rollups(cur, group_id)
+    cur.execute("UPDATE groups SET archived = true WHERE id = %s;", (group_id,))
+    cur.execute("SELECT count(*) AS count FROM messages WHERE group_id = %s;",
+                (group_id,))
+    count = cur.fetchone()['count']
+    cur.connection.commit()
+    print("Imported", group_id, count, "messages archived,", exported, "exported",
+          file=sys.stderr)
+
+
+def rebuild_rollups(cur, group_id):
+    """Recompute the timeline bounds and per-day counts of a group."""
+
+    cur.execute("DELETE FROM timeline_bounds WHERE group_id = %s;", (group_id,))
+    cur.execute("""
+      INSERT INTO timeline_bounds
+      SELECT group_id, CASE WHEN GROUPING(user_id) = 1 THEN '' ELSE user_id END,
+             min(created_at), max(created_at), count(*)
+      FROM messages WHERE group_id = %s
+      GROUP BY GROUPING SETS ((group_id), (group_id, user_id))
+    """, (group_id,))
+    cur.execute("DELETE FROM message_days WHERE group_id = %s;", (group_id,))
+    cur.execute("""
+      INSERT INTO message_days (group_id, user_id, day, message_count)
+      SELECT group_id, CASE WHEN GROUPING(user_id) = 1 THEN '' ELSE user_id END, day, count(*)
+      FROM (SELECT group_id, user_id, (created_at AT TIME ZONE 'UTC')::date AS day
+            FROM messages WHERE group_id = %s) m
+      GROUP BY GROUPING SETS ((group_id, day), (group_id, user_id, day))
+    """, (group_id,))
+    cur.execute("""
+      INSERT INTO message_days (group_id, user_id, day, message_count, likes_received, likes_given)
+      SELECT group_id, CASE WHEN GROUPING(user_id) = 1 THEN '' ELSE user_id END, day, 0, count(*),
+             CASE WHEN GROUPING(user_id) = 1 THEN count(*) ELSE 0 END
+      FROM (SELECT m.group_id, m.user_id, (m.created_at AT TIME ZONE 'UTC')::date AS day
+            FROM message_likes l JOIN messages m ON m.id = l.message_id
+            WHERE m.group_id = %s) liked
+      GROUP BY GROUPING SETS ((group_id, day), (group_id, user_id, day))
+      ON CONFLICT (group_id, user_id, day) DO UPDATE
+      SET likes_received = EXCLUDED.likes_received, likes_given = EXCLUDED.likes_given
+    """, (group_id,))
+    cur.execute("""
+      INSERT INTO message_days (group_id, user_id, day, message_count, likes_given)
+      SELECT m.group_id, l.user_id, (m.created_at AT TIME ZONE 'UTC')::date, 0, count(*)
+      FROM message_likes l JOIN messages m ON m.id = l.message_id
+      WHERE m.group_id = %s
+      GROUP BY 1, 2, 3
+      ON CONFLICT (group_id, user_id, day) DO UPDATE SET likes_given = EXCLUDED.likes_given
+    """, (group_id,))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog='app.py', description="Move archived groups between instances.")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    export_parser = commands.add_parser(
+        'export', help="write groups to a compressed export file")
+    import_parser = commands.add_parser(
+        'import', help="load an export file into the archive")
+    for command_parser in (export_parser, import_parser):
+        command_parser.add_argument('database')
+        command_parser.add_argument('user', nargs='?')
+        command_parser.add_argument('password', nargs='?')
+    export_parser.add_argument(
+        '-g', '--group', dest='groups', action='append', default=[],
+        metavar='GROUP_ID',
+        help="group or DM partner to export, may be repeated (default: every archived group)")
+    export_parser.add_argument(
+        '-o', '--output', default='-',
+        help="file to write (default: standard output)")
+    import_parser.add_argument(
+        '-i', '--input', default='-',
+        help="file to read (default: standard input)")
+    args = parser.parse_args(argv)
+
+    conn = psycopg2.connect(
+        database=args.database,
+        user=args.user,
+        password=args.password)
+    # Standard output may be the export itself.
+    with contextlib.redirect_stdout(sys.stderr):
+        migrate(conn)
+
+    if args.command == 'export':
+        path, std, mode = args.output, sys.stdout.buffer, 'wb'
+    else:
+        path, std, mode = args.input, sys.stdin.buffer, 'rb'
+    file = open(path, mode) if path != '-' else std
+    try:
+        if args.command == 'export':
+            export(conn, args.groups, file)
+        else:
+            import_archive(conn, file)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    finally:
+        if file is not std:
+            file.close()
+    return 0